@@ -1,14 +1,38 @@
 # /usr/bin/python3
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, make_response, stream_with_context
 import base64
+import importlib
+import json
 import os
+import threading
+import time
 
-from .tools.plot_functions import plot_function
-from .tools.demo import demo
-from .tools.agent import init_agent, run_agent
+from .tools.agent import run_agent, stream_run
+from .tools.sessions import sessions
 
 api = Blueprint("api", __name__)
 
+# Tool modules with heavy dependencies (smolagents, litellm, numpy, matplotlib) are
+# imported by the handlers needing them, so that starting a worker stays cheap
+HEAVY_MODULES = (".tools.writing_tools", ".tools.plot_functions")
+
+
+def warm_up():
+    """Imports the heavy tool modules, so that the first requests do not wait for them."""
+    start = time.perf_counter()
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name, __package__)
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+    print(f"Warm-up done in {time.perf_counter() - start:.2f}s")
+
+
+def start_warm_up() -> threading.Thread:
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
 PREDEFINED_REPONSE = [
     {
         "balise": "cours",
@@ -24,29 +48,99 @@ PREDEFINED_REPONSE = [
     },
 ]
 
-text_blocks = dict()
+SESSION_HEADER = "X-Session-Id"
+COALESCED_HEADER = "X-Coalesced"  # Set when the answer is also sent to an earlier submission
+
+
+def get_session(data: dict):
+    """Returns the session of the request, None if it is unknown or expired."""
+    session_id = data.get("session_id") or request.headers.get(SESSION_HEADER, "")
+    return sessions.get(session_id)
+
+
+def session_gone():
+    """Response to a request of an unknown or expired session, the client calls /api/init again."""
+    return jsonify({"error": "Unknown or expired session, call /api/init to start a new one"}), 410
 
 
 @api.route("/body", methods=["POST"])
 def body_api():
     data = request.json
-    text_blocks[data["id"]] = {"text": data["text"], "balise": data["balise"]}
+    session = get_session(data)
+    if session is None:
+        return session_gone()
 
     try:
-        return run_agent([text_blocks[key] for key in sorted(text_blocks.keys())])
+        # Submissions arriving together are answered by a single run
+        answer, coalesced = sessions.submit(
+            session,
+            data["id"],
+            data["text"],
+            data["balise"],
+            lambda: run_agent(session.agent, session.document),
+        )
+        response = make_response(answer)
+        response.headers[SESSION_HEADER] = session.id
+        if coalesced:
+            response.headers[COALESCED_HEADER] = "1"
+        return response
     except Exception as e:
         print("got error: ", e)
-        with open(os.path.join(os.path.dirname(__file__), "api_failure.png"), "rb") as f:
-            image_data = f.read()
-            image_base64 = base64.b64encode(image_data).decode("utf-8")
-            return jsonify({
-                "balise": "media_image", 
-                "text": f"data:image/png;base64,{image_base64}"
-            })
+        return jsonify(failure_response())
+
+
+@api.route("/body/stream", methods=["POST"])
+def body_stream_api():
+    """Streaming variant of /api/body, as Server-Sent Events."""
+    data = request.json
+    session = get_session(data)
+    if session is None:
+        return session_gone()
+
+    def run():
+        # A submission joining a run started by another one only gets its result event
+        answer, _ = sessions.submit(
+            session,
+            data["id"],
+            data["text"],
+            data["balise"],
+            lambda: run_agent(session.agent, session.document),
+        )
+        return answer
+
+    def generate():
+        for event in stream_run(run):
+            if event["event"] == "error":
+                print("got error: ", event["error"])
+                event = {"event": "result", **failure_response()}
+            name = event.pop("event")
+            yield f"event: {name}\ndata: {json.dumps(event)}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            SESSION_HEADER: session.id,
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Disables proxy buffering of the stream
+        },
+    )
+
+
+def failure_response() -> dict:
+    with open(os.path.join(os.path.dirname(__file__), "api_failure.png"), "rb") as f:
+        image_data = f.read()
+        image_base64 = base64.b64encode(image_data).decode("utf-8")
+        return {
+            "balise": "media_image",
+            "text": f"data:image/png;base64,{image_base64}"
+        }
 
 
 @api.route("/demo", methods=["POST"])
 def demo_api():
+    from .tools.demo import demo
+
     data = request.json
     return demo(data)
 
@@ -61,13 +155,53 @@ def process_text():
 
 @api.route("/plot", methods=["POST"])
 def plot_api():
+    from .tools.plot_functions import plot_function, plot_etag, parse_bounds, PlotError
+
     try:
         data = request.json
         function_str = data.get("text", "")
-        x_min = float(data.get("xMin", 0))
-        x_max = float(data.get("xMax", 1))
+        try:
+            x_min, x_max = parse_bounds(data)
+        except PlotError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Repeat requests for the same plot are answered without rendering it
+        etag = plot_etag(function_str, x_min, x_max)
+        if etag is not None and request.if_none_match.contains(etag):
+            return "", 304, {"ETag": f'"{etag}"'}
+
+        response = make_response(plot_function(function_str, x_min, x_max))
+        if etag is not None and response.status_code == 200:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"  # Revalidate with If-None-Match
+        return response
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@api.route("/plot/batch", methods=["POST"])
+def plot_batch_api():
+    """Plots several functions in one request, overlaid (default) or as separate images."""
+    from .tools.plot_functions import parse_batch, batch_etag, plot_batch, PlotError
+
+    try:
+        data = request.json
+        overlay = bool(data.get("overlay", True))
+        try:
+            items = parse_batch(data.get("functions"))
+        except PlotError as e:
+            return jsonify({"error": str(e)}), 400
+
+        etag = batch_etag(items, overlay)
+        if request.if_none_match.contains(etag):
+            return "", 304, {"ETag": f'"{etag}"'}
 
-        return plot_function(function_str, x_min, x_max)
+        response = make_response(plot_batch(items, overlay))
+        if response.status_code == 200:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+        return response
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -133,8 +267,8 @@ def initialize_agent_api():
 
         print("Fixed questions for agent:", fixed_questions)
 
-        # Initialize the agent with the fixed questions
-        init_agent(fixed_questions)
+        # Initialize a new session with the fixed questions
+        session = sessions.create(fixed_questions)
 
         # Create a comprehensive response
         response_data = {
@@ -147,6 +281,7 @@ def initialize_agent_api():
                 "selected_topics": selected_topics,
                 "timestamp": timestamp,
             },
+            "session_id": session.id,
             "agent_status": "initialized",
             "fixed_questions_count": len(fixed_questions),
             "ready_for_interaction": True,
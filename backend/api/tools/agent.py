@@ -1,12 +1,33 @@
 # /usr/bin/python3
-from smolagents import CodeAgent, LiteLLMModel, WebSearchTool, Tool
-from .context_building import build_context
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+from .cancellation import CancellationToken, cancellable, check_cancelled, current_token
+from .context_budget import ContextBudget
+from .context_building import UserStateEstimate, build_context, start_user_state
+from .document import DocumentContext, USER_RESPONSE_BALISE, count_tokens, render_message
+from .llm_cache import response_cache
+from .models import ModelRegistry
+from .prefetch import FOLLOW_UPS, Prefetch, start_prefetch
+from .session_logs import log_session, logger
 from os import path, getenv
+import ast
+import copy
 import dotenv
+import json
+import queue
+import threading
 
-USER_RESPONSE_BALISE = "human_response"
 DEBUG = True
 MEDIUM_LLM = "claude-sonnet-4-20250514"
+SMALL_LLM = "claude-3-5-haiku-latest"
+
+# Start the manager alongside the question check when the questionnaire makes it likely to pass
+SPECULATIVE_MANAGER = getenv("SPECULATIVE_MANAGER", "1") != "0"
+SPECULATIVE_WORKERS = 8
+
+# "structured" routes with a single JSON-schema call, "agent" with the manager CodeAgent only
+ROUTER_MODE = getenv("ROUTER_MODE", "structured")
+ROUTES = ("cours", "question", "nothing")
 
 dotenv.load_dotenv()
 
@@ -23,21 +44,76 @@ if api_key == "":  # api_key should be globally defined TODO
         )
 
 
-def log(message: str):
-    with open("log.txt", "a") as f:
-        f.write(message + "\n")
+# Event sink of the run streamed by the current thread, see stream_run
+_events = threading.local()
+
+
+def emit_event(event: dict):
+    """Sends an event to the stream of the current run, if it is streamed."""
+    sink = getattr(_events, "sink", None)
+    if sink is not None:
+        sink(event)
+
+
+# User state estimation of the manager run in progress in the current thread, see forward_manager
+_user_state = threading.local()
+
+
+def with_user_state(context: str) -> str:
+    """Adds the user state estimated for the current manager run to a writer context, waiting for it until its deadline."""
+    estimate = getattr(_user_state, "estimate", None)
+    if estimate is None:
+        return context
+    return build_context(context, estimate)
+
+
+def call_model(name: str, prompt: str, **kwargs) -> str:
+    """
+    Calls a model of the registry on a single user prompt and returns its answer.
+
+    In a cancellable run the answer is streamed, so that a cancelled run stops reading
+    it between two chunks and closes its request instead of waiting for all of it.
+    Only the wait for the first chunk cannot be interrupted.
+    """
+    model = model_registry.get(name)
+    messages = [{"role": "user", "content": prompt}]
+    token = current_token()
+    if token is None:
+        return model(messages=messages, **kwargs).content
+    chunks = []
+    stream = model.generate_stream(messages, **kwargs)
+    try:
+        for delta in stream:
+            token.check()
+            if delta.content:
+                chunks.append(delta.content)
+    finally:
+        stream.close()
+    return "".join(chunks)
+
+
+def is_streamed() -> bool:
+    return getattr(_events, "sink", None) is not None
+
+
+def report_manager_step(memory_step):
+    # Between manager steps, also stops superseded runs
+    check_cancelled()
+    emit_event({"event": "step", "type": "manager_step", "step": memory_step.step_number})
 
 
 class Agent:
     fixed_questions: list[dict] = None
     fixed_context: list[dict] = None
-    models: dict = None
+    fixed_context_rendered: str = ""
+    session_id: str = None  # Tags the logs of the agent's runs, see run_agent
+    budget: ContextBudget = None
+    prefetched: Prefetch = None  # Likely next answer, written in the background
     initialized: bool = False
     questioning_ended: bool = False
 
     def init(self, fixed_questions):
         self.fixed_questions = fixed_questions
-        define_models(self)
 
         # Add fixed questions as initial context
         fixed_context = []
@@ -47,37 +123,50 @@ class Agent:
             # Add the answer as user message
             fixed_context.append({"role": "user", "content": fq["answer"]})
         self.fixed_context = fixed_context
+        self.fixed_context_rendered = self.stringify_context(fixed_context)
+        self.budget = ContextBudget(summarize_span)
         self.initialized = True
-        with open("log.txt", "w") as f:
-            f.write(f"Agent initializated with fixed questions: {fixed_questions}.\n")
+        logger.info("Agent initialized with fixed questions: %s", fixed_questions)
 
-    def forward(self, body: list[dict]) -> list[dict]:
-        # Input is of form  [{"balise": "question", "content": "some text"}]
+    def forward(self, document: DocumentContext) -> list[dict]:
+        # Input is the session's document of {"balise": "question", "text": "some text"} blocks
         # Output is of form [{"balise": "question", "text": "some text"}]
 
         if not self.initialized:
             self.init(
                 []
             )  # Initialize with empty fixed questions if not already initialized
-            log("Agent not initialized, initializing with empty fixed questions.")
+            logger.warning("Agent not initialized, initializing with empty fixed questions.")
 
-        if len(body) == 0:
+        if len(document) == 0:
             return [{"balise": None, "text": None}]
 
-        log("Body:\n" + str(body))
-
-        translated_body = translate_json(body)
-        anthropified_body = anthropify_body(translated_body)
-        body_with_fixed_context = self.fixed_context + anthropified_body
-        context: str = self.stringify_context(body_with_fixed_context)
-
-        log(f"\nContext built:\n {context}")
+        # Only changed blocks are logged, the earlier ones are already in the session log
+        for block_id in document.pop_changes():
+            block = document.get_block(block_id)
+            logger.debug("Block %s changed (%s):\n%s", block_id, block["balise"], block["text"])
+
+        # Only the runs around changed blocks are re-merged and re-rendered, and
+        # older runs are summarized once the document outgrows the token budget
+        context: str = self.budget.render(document, reserved=count_tokens(self.fixed_context_rendered))
+        if self.fixed_context_rendered:
+            context = self.fixed_context_rendered + "\n" + context
+
+        logger.debug(
+            "Context built: %d blocks, %d tokens sent out of %d",
+            len(document),
+            count_tokens(context),
+            document.tokens + count_tokens(self.fixed_context_rendered),
+        )
 
         if self.questioning_ended:
-            log("Forwarding to manager due to questioning_ended flag being true.")
-            return self.forward_manager(context)
+            logger.info("Forwarding to manager due to questioning_ended flag being true.")
+            emit_event({"event": "step", "type": "routing", "agent": "manager"})
+            # Runs alongside the manager, see forward_manager
+            return self.forward_manager(context, start_user_state(context))
         else:
-            log("Forwarding to question agent.")
+            logger.info("Forwarding to question agent.")
+            emit_event({"event": "step", "type": "routing", "agent": "initial_questions"})
             return self.forward_question(context)
 
     def forward_question(self, context: str) -> list[dict]:
@@ -107,23 +196,48 @@ class Agent:
         -`Are you interested in numerical methods or theoretical aspects of Markov Chains?`
     """
         prompt = str(prompt.format(history=context))
-        answer = models["initial_questions"](
-            messages=[{"role": "user", "content": prompt}], max_tokens=1000
-        ).content
-        log("Returned answer from initial questions model:\n" + answer)
+
+        # The user state is only estimated for a manager run: most question turns end without one
+        speculative = None
+        if SPECULATIVE_MANAGER and self.questionnaire_covers_basics():
+            logger.info("Starting the manager speculatively alongside the question check.")
+            speculative = SpeculativeRun(self, context, start_user_state(context))
+
+        try:
+            answer = call_model("initial_questions", prompt, max_tokens=1000)
+        except Exception:
+            if speculative is not None:
+                speculative.discard()
+            raise
+        logger.info("Returned answer from initial questions model:\n%s", answer)
+        check_cancelled()
         if "[%QE%]" not in answer:
+            if speculative is not None:
+                logger.info("Question check did not pass, discarding the speculative manager run.")
+                speculative.discard()
             return {"balise": "question", "text": answer}
         else:
-            log("Context is sufficient to start teaching, transferring to manager.")
+            logger.info("Context is sufficient to start teaching, transferring to manager.")
             self.questioning_ended = True
-            return self.forward_manager(context)
+            emit_event({"event": "step", "type": "routing", "agent": "manager"})
+            if speculative is not None:
+                return speculative.accept()
+            return self.forward_manager(context, start_user_state(context))
 
-    def forward_manager(self, context: str) -> list[dict]:
+    def questionnaire_covers_basics(self) -> bool:
+        """Whether the fixed questions already give the level and the subject of the learner."""
+        types = {fq.get("type") for fq in self.fixed_questions or []}
+        return "education_level" in types and bool(types & {"subjects", "topics"})
+
+    def forward_manager(self, context: str, user_state: UserStateEstimate) -> list[dict]:
         """
         Processes the input body and returns a response based on the agent's logic.
 
         Args:
-            body (list[dict]): The input body containing user messages and other relevant information.
+            context (str): The rendered context of the conversation.
+            user_state (UserStateEstimate): The user state estimation started with the run. If it
+                is ready, it is added to the manager's context, otherwise the writer tools
+                wait for it (until its deadline) while the manager plans its first step.
 
         Returns:
             list[dict]: The response generated by the agent.
@@ -134,121 +248,321 @@ class Agent:
 
         # context[-1]["content"] = "### ORIGINAL USER PROMPT ###\n" + context[-1]["content"] + "\n### SYSTEM PROMPT ###\n" + "Do not talk to the user. Your output will be the prompt of another AI agent. You have to analyze all the context that is given to you and reduce it to a single string. This string should contain the most important information that the user has given you, and that you have given to the user. It should be a summary of the conversation, and it should be short while still being informative. The context you produce will be the prompt to another ageint, so it should contain all the relevant information about the user's state and the conversation history. Most importantly, you should take a lot of care about whether the user would be interested in a course explanation or a question to verify their understanding. Do include as much information as possible about the user's state for example."
 
-        answer = models["manager"].run(
-            context
-            + '\n\n### SYSTEM PROMPT ###\n Your task is to analyze the context and decide which agent to use. If you think the user needs help with the course, ask course_agent to give you a paragraph about a specific topic you will ask it about, and return it. The topic you give to the course agent needs to be a single, specific topic that you decided about. Do NOT give him multiple topics. If you think it would be good for the user to confirm their knowledge, ask question_agent to ask a question about the course. Specify a single, specific topic on which the question agent should write about. Return an answer after a single tool use, so that your returned answer is a dict of the form \'{"balise": agent_used_type (cours or question), "text": content_to_return}\'. To do so and not make a typo, write a python program that writes this dict. The returned answer might contain UTF-8, make sure to take this into account; also make sure to escape the backslash character. If you don\'t want to return anything since the answers you are do not meet your quality standards, you may decide to return nothing, in this case, use the "nothing" balise. If an agent returns an answer you deem unwanted or unnecessary, or it does not meet your quality standards, you may decide to try again, ask another agent or, and it should sometimes be preferred, return nothing. For example, if the last things the user wrote are unrelated to their communication with you, leave them be instead of sending them information they did not ask for.'
-        )
-        log("Manager answer:\n" + str(answer))
+        from .writing_tools import agent_pools, run_manager, writing_tools
+
+        if user_state.future.done():
+            context = build_context(context, user_state)
+        else:
+            _user_state.estimate = user_state
+
+        try:
+            if ROUTER_MODE == "structured":
+                try:
+                    balise, topic = self.route(context)
+                except Exception as e:
+                    # Falls back to the manager agent below
+                    logger.warning("Structured routing failed: %s", e)
+                else:
+                    check_cancelled()
+                    if balise == "nothing":
+                        self.drop_prefetch()
+                        return {"balise": "nothing", "text": ""}
+                    text = self.take_prefetch(balise, topic)
+                    if text is None:
+                        text = writing_tools[balise].forward(context, topic)
+                    self.prefetch_follow_up(balise, topic, context, text)
+                    return {"balise": balise, "text": text}
+
+            self.drop_prefetch()
+            emit_event({"event": "step", "type": "routing", "agent": "manager_agent"})
+            with agent_pools["manager"].checkout() as manager:
+                token = current_token()
+                stop_interrupt = token.on_cancel(manager.interrupt) if token else (lambda: None)
+                try:
+                    answer = run_manager(
+                        manager,
+                        context
+                        + '\n\n### SYSTEM PROMPT ###\n Your task is to analyze the context and decide which agent to use. If you think the user needs help with the course, ask course_agent to give you a paragraph about a specific topic you will ask it about, and return it. The topic you give to the course agent needs to be a single, specific topic that you decided about. Do NOT give him multiple topics. If you think it would be good for the user to confirm their knowledge, ask question_agent to ask a question about the course. Specify a single, specific topic on which the question agent should write about. Return an answer after a single tool use, so that your returned answer is a dict of the form \'{"balise": agent_used_type (cours or question), "text": content_to_return}\'. To do so and not make a typo, write a python program that writes this dict. The returned answer might contain UTF-8, make sure to take this into account; also make sure to escape the backslash character. If you don\'t want to return anything since the answers you are do not meet your quality standards, you may decide to return nothing, in this case, use the "nothing" balise. If an agent returns an answer you deem unwanted or unnecessary, or it does not meet your quality standards, you may decide to try again, ask another agent or, and it should sometimes be preferred, return nothing. For example, if the last things the user wrote are unrelated to their communication with you, leave them be instead of sending them information they did not ask for.'
+                    )
+                except Exception:
+                    # An interrupted manager raises an AgentError, report the cancellation instead
+                    check_cancelled()
+                    raise
+                finally:
+                    stop_interrupt()
+        finally:
+            _user_state.estimate = None
+        logger.info("Manager answer:\n%s", answer)
         # Returns a {"text":..., "balise":...}
         return answer
 
-    def stringify_context(self, context: list[dict]) -> str:
-        return "\n".join(
-            [f"### {msg['role']} ###\n{msg['content']}\n" for msg in context]
-        )
+    def route(self, context: str) -> tuple[str, str]:
+        """
+        Decides in a single structured LLM call whether to write a course, a question or nothing.
 
+        Returns:
+            tuple[str, str]: The balise of the answer ("cours", "question" or "nothing") and its topic.
 
-agent = Agent()
-models = dict()
+        Raises:
+            ValueError: If the decision is malformed.
+        """
+        # The prefetched follow-up is not hinted: it must not sway the decision, see take_prefetch
+        prompt = ROUTER_PROMPT.format(context=context)
+        answer = call_model("router", prompt, response_format=ROUTER_RESPONSE_FORMAT)
+        balise, topic = parse_route(answer)
+        logger.info("Routed to %s, topic: %s", balise, topic)
+        emit_event({"event": "step", "type": "route", "balise": balise, "topic": topic})
+        return balise, topic
+
+    def prefetch_follow_up(self, balise: str, topic: str, context: str, text: str):
+        """Starts writing the likely next answer, e.g. a question on the topic of a course."""
+        from .writing_tools import writing_tools
+
+        follow_up = FOLLOW_UPS.get(balise)
+        if follow_up is None:
+            return
+        self.drop_prefetch()
+        # The follow-up is written as if the answer was already in the document
+        context = context + "\n" + render_message("assistant", f"### {balise} ###\n{text}")
+        self.prefetched = start_prefetch(
+            self.session_id, follow_up, topic, lambda: writing_tools[follow_up].forward(context, topic)
+        )
 
+    def take_prefetch(self, balise: str, topic: str) -> str | None:
+        """Returns the prefetched answer if it matches the routing decision, waiting for it if needed."""
+        prefetch, self.prefetched = self.prefetched, None
+        if prefetch is None:
+            return None
+        if not prefetch.matches(balise, topic):
+            logger.info("Routing went in another direction, dropping the prefetched %s.", prefetch.balise)
+            prefetch.cancel()
+            return None
+        try:
+            text = prefetch.future.result()
+        except Exception as e:
+            logger.warning("Prefetch failed: %s", e)
+            return None
+        logger.info("Serving the prefetched %s on: %s", balise, topic)
+        emit_event({"event": "token", "text": text})
+        return text
+
+    def drop_prefetch(self):
+        if self.prefetched is not None:
+            self.prefetched.cancel()
+            self.prefetched = None
 
-def init_agent(fixed_questions: list[dict]):
-    """Initialize the agent with fixed questions from the questionnaire"""
-    log("Initializing agent with fixed questions from init_agent.")
-    agent.init(fixed_questions)
+    def stringify_context(self, context: list[dict]) -> str:
+        return "\n".join([render_message(msg["role"], msg["content"]) for msg in context])
 
 
-def run_agent(body: list[dict]) -> list[dict]:
-    return agent.forward(body)
+ROUTER_PROMPT = """{context}
 
+### SYSTEM PROMPT ###
+Your task is to analyze the context and decide how to help the user. If you think the user needs help with the course, choose "cours" and give a single, specific topic to explain. If you think it would be good for the user to confirm their knowledge, choose "question" and give a single, specific topic to ask about. Do NOT give multiple topics. If the last things the user wrote are unrelated to their communication with you, or an answer would not help them, choose "nothing" instead of sending them information they did not ask for.
 
-class CourseWritingTool(Tool):
-    name = "course_writing_tool"
-    description = """This tool is responsible for explaining large concepts to the user. If the user seems stuck on some specific content, the course_writing_tool would be interesting to use to explain the user the concept he is lacking.  It is also used to answer the user's questions about the course, such as 'What is a Markov Chain?' or 'What is Young's double-slit experiment?'. The course_writing_tool is also used to explain the course step by step, and to answer the user's questions about the course."""
+Answer with a JSON object of the form {{"balise": "cours" | "question" | "nothing", "topic": "the topic"}}, the topic being empty for "nothing"."""
 
-    inputs = {
-        "context": {
-            "type": "string",
-            "description": "The context of the conversation, including the user's level of understanding, previous messages, and any relevant information the course_writing_tool could use. This context will be used to tailor the explanation to the user's needs.",
+ROUTER_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "route",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "balise": {"type": "string", "enum": list(ROUTES)},
+                "topic": {"type": "string"},
+            },
+            "required": ["balise", "topic"],
+            "additionalProperties": False,
         },
-        "topic": {
-            "type": "string",
-            "description": "The specific topic of the course to explain, as a single point to explain. For example, 'Transition matrices in Markov Chains' or 'The principle of Young's double-slit experiment'.",
-        },
-    }
+    },
+}
 
-    output_type = "string"
 
-    def forward(self, context: str, topic: str) -> str:
-        prompt = """### SYSTEM PROMPT ###\nYou are a helpful agent that writes courses on various topics. You will be given a context of the conversation and a topic to explain. Your task is to write a course text about the topic, using the context to tailor your explanation to the user's needs.\n\n### CONTEXT ###\n{context}\n\n### TOPIC ###\n{topic}\n\n### SYSTEM PROMPT ###\nDo NOT complain, do NOT ask for more information on your task, and do NOT answer as a chatbot. You should answer a short text about on the given topic. You should only use web search if you cannot come up with any course content by yourself or make sure you are right about a complex point, otherwise, you HAVE to return in a single run. If necessary, can think about a full course but should only teach about ONE SINGLE point of the course; as follow up points can be discussed later.\n\n### OUTPUT FORMAT ###\nReturn a short text explaining the topic, the size of a paragraph but using line skips, using the context to tailor your explanation to the user's needs. Do not include any additional information or explanations, just the course content on a single topic. Feel free to use LaTeX syntax, using $ as bounds, e.g. $e^{{-ix^2}} + u_2 = 6 \\times 4$; also make sure to escape the backslash character
-        """.format(context=context, topic=topic)
-        return models["course"].run(prompt)
+def parse_route(answer: str) -> tuple[str, str]:
+    """Parses the JSON decision of the router, tolerating a markdown code fence around it."""
+    text = answer.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        decision = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Routing decision is not JSON: {answer!r}") from e
+    if not isinstance(decision, dict) or decision.get("balise") not in ROUTES:
+        raise ValueError(f"Unknown routing decision: {answer!r}")
+    balise, topic = decision["balise"], str(decision.get("topic") or "").strip()
+    if balise != "nothing" and not topic:
+        raise ValueError(f"Routing decision without a topic: {answer!r}")
+    return balise, topic
 
 
-class QuestionWritingTool(Tool):
-    name = "question_writing_tool"
-    description = """This tool is responsible for asking questions to the user to verify the user's understanding of the course. When the user seems to have understood the course, the question_writing_tool will ask questions to verify the user's understanding. If the user seems to be stuck on some specific content, the question_writing_tool will ask questions to help the user understand the concept he is lacking. The question_writing_tool is also used to ask questions about the user's understanding of the course, such as 'Do you feel like you completely understand what a Markov Chain is?' or 'Do you know the principle behind Young's double-slit experiment?'. The question_writing_tool should only return a single question, and should not complain or ask for more information on its task."""
+_speculative_runs = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative")
 
-    inputs = {
-        "context": {
-            "type": "string",
-            "description": "The context of the conversation, including the user's level of understanding, previous messages, and any relevant information the question_writing_tool could use. This context will be used to tailor the question to the user's needs.",
-        },
-        "topic": {
-            "type": "string",
-            "description": "The specific topic of the course to ask a question about, as a single point to ask about. For example, 'Transition matrices in Markov Chains' or 'The principle of Young's double-slit experiment'.",
-        },
-    }
-
-    output_type = "string"
-
-    def forward(self, context: str, topic: str) -> str:
-        prompt = """### SYSTEM PROMPT ###\nYou are a helpful agent that writes questions on various topics. You will be given a context of the conversation and a topic to ask a question about. Your task is to write a question about the topic, using the context to tailor your question to the user's needs.\n\n### CONTEXT ###\n{context}\n\n### TOPIC ###\n{topic}\n\n### SYSTEM PROMPT ###\nDo NOT complain, do NOT ask for more information on your task, and do NOT answer as a chatbot. You should write a question about a SINGLE topic. You should only use web search if you cannot come up with any question by yourself or make sure you are right about a complex point, otherwise, you HAVE to return in a single run. If necessary, can think about a full course but should only ask ONE SINGLE question about the course, as a single point; as follow up points can be discussed later.\n\n### OUTPUT FORMAT ###\nReturn a single question asking about the topic, using the context to tailor your question to the user's needs. Do not include any additional information or explanations, just the question. Feel free to use LaTeX syntax, using $ as bounds, e.g. $e^{{-ix^2}} + u_2 = 6 \\times 4$\n; also make sure to escape the backslash character.
-      """.format(context=context, topic=topic)
-        return models["question"].run(prompt)
-
-
-def define_models(agent) -> dict:
-    models["course"] = CodeAgent(
-        model=LiteLLMModel(
-            model_id=MEDIUM_LLM,
-            api_key=api_key,
-            temperature=0.2,
-            max_tokens=2000,
-        ),
-        tools=[WebSearchTool()],
-        max_steps=3,
-    )
 
-    models["question"] = CodeAgent(
-        model=LiteLLMModel(
-            model_id=MEDIUM_LLM,
-            api_key=api_key,
-            temperature=0.2,
-            max_tokens=1000,
-        ),
-        tools=[WebSearchTool()],
-        max_steps=3,
-    )
+class SpeculativeRun:
+    """
+    Manager run started before the question check passes. The events it emits are held
+    back until it is accepted, and dropped with its result if it is discarded.
 
-    models["manager"] = CodeAgent(
-        model=LiteLLMModel(
-            model_id=MEDIUM_LLM,
-            api_key=api_key,
-            temperature=0.1,
-            max_tokens=3000,
-        ),
-        name="manager_agent",
-        description="This Agent is responsible for managing the conversation between the user and the course_agent and question_agent. It decides which agent to use based on the user's input and the context of the conversation. The manager_agent can also choose not to do anything if it believes it wouldn't help the user, or the user did not write enough to warrant an answer.",
-        tools=[CourseWritingTool(), QuestionWritingTool()],
-        max_steps=5,
-    )
+    A discarded run only stops at its next cancellation check, possibly after the
+    session's next run started. It therefore runs on a copy of the agent with its own
+    prefetch slot: the follow-up it prefetches is handed to the agent when it is
+    accepted, and cancelled once it finishes when it is discarded.
+    """
+
+    def __init__(self, agent: Agent, context: str, user_state: UserStateEstimate):
+        self._held: list[dict] = []
+        self._sink = None
+        self._lock = threading.Lock()
+        self._agent = agent
+        self._view = copy.copy(agent)
+        self._view.prefetched = None
+        # Cancelled when discarded, or with the run that started it
+        self.token = CancellationToken(parent=current_token())
+        self.future = _speculative_runs.submit(self._run, self._view, context, user_state)
+
+    def _run(self, agent: Agent, context: str, user_state: UserStateEstimate) -> list[dict]:
+        _events.sink = self._emit
+        try:
+            with log_session(agent.session_id), cancellable(self.token):
+                return agent.forward_manager(context, user_state)
+        finally:
+            _events.sink = None
+
+    def _emit(self, event: dict):
+        with self._lock:
+            if self._sink is None:
+                self._held.append(event)
+            else:
+                self._sink(event)
+
+    def accept(self) -> list[dict]:
+        """Forwards the held events to the stream of the current thread, then waits for the result."""
+        sink = getattr(_events, "sink", None)
+        with self._lock:
+            if sink is not None:
+                for event in self._held:
+                    sink(event)
+            self._held.clear()
+            self._sink = sink or (lambda event: None)
+        try:
+            answer = self.future.result()
+        except BaseException:
+            self._view.drop_prefetch()
+            raise
+        finally:
+            self.token.detach()
+        if self._view.prefetched is not None:
+            self._agent.drop_prefetch()
+            self._agent.prefetched = self._view.prefetched
+        return answer
+
+    def discard(self):
+        # A run that already started stops at its next cancellation check
+        self.future.cancel()
+        self.token.cancel()
+        self.token.detach()
+        with self._lock:
+            self._held.clear()
+            self._sink = lambda event: None
+        # Including the follow-up it may prefetch before stopping
+        self.future.add_done_callback(lambda future: self._view.drop_prefetch())
+
+
+def init_agent(fixed_questions: list[dict], session_id: str = None) -> Agent:
+    """Creates an agent initialized with fixed questions from the questionnaire"""
+    agent = Agent()
+    agent.session_id = session_id
+    with log_session(session_id):
+        agent.init(fixed_questions)
+    return agent
+
+
+def run_agent(agent: Agent, document: DocumentContext) -> list[dict]:
+    with log_session(agent.session_id):
+        return agent.forward(document)
 
-    models["initial_questions"] = LiteLLMModel(
-        model_id=MEDIUM_LLM,
-        temperature=0.3,
-        api_key=api_key,  # in practice we would not hardcode the API key, but use an environment variable or a secure vault service
+
+def stream_run(run: Callable[[], dict]) -> Iterator[dict]:
+    """
+    Runs an agent run in a worker thread and yields the events it emits as they arrive.
+
+    Args:
+        run (Callable): Performs the run and returns the agent answer, e.g. a call to run_agent.
+
+    Yields:
+        dict: Step and token events, then a final {"event": "result", "balise", "text"} event,
+        or {"event": "error", "error"} if the run failed.
+    """
+    events = queue.Queue()
+
+    def worker():
+        _events.sink = events.put
+        try:
+            events.put({"event": "result", **as_envelope(run())})
+        except Exception as e:
+            events.put({"event": "error", "error": str(e)})
+        finally:
+            _events.sink = None
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while (event := events.get()) is not None:
+        yield event
+
+
+def as_envelope(answer) -> dict:
+    """Normalizes an agent answer to a {"balise", "text"} dict."""
+    if isinstance(answer, list):
+        answer = answer[0]
+    if isinstance(answer, str):
+        # The manager may return the dict it was asked to write as a literal
+        answer = ast.literal_eval(answer)
+    if not isinstance(answer, dict) or "balise" not in answer:
+        raise ValueError(f"Malformed agent answer: {answer!r}")
+    return {"balise": answer["balise"], "text": answer.get("text")}
+
+
+# Clients shared by every session, each built on first use
+model_registry = ModelRegistry(
+    {
+        "course": {"model_id": MEDIUM_LLM, "temperature": 0.2, "max_tokens": 2000},
+        "question": {"model_id": MEDIUM_LLM, "temperature": 0.2, "max_tokens": 1000},
+        "manager": {"model_id": MEDIUM_LLM, "temperature": 0.1, "max_tokens": 3000},
+        "initial_questions": {"model_id": MEDIUM_LLM, "temperature": 0.3},
+        "user_state": {"model_id": SMALL_LLM, "temperature": 0.3, "max_tokens": 300},
+        "router": {"model_id": MEDIUM_LLM, "temperature": 0.1, "max_tokens": 300},
+        "summary": {"model_id": SMALL_LLM, "temperature": 0.0, "max_tokens": 500},
+    },
+    api_key,  # in practice we would not hardcode the API key, but use an environment variable or a secure vault service
+)
+
+
+SUMMARY_PROMPT = """### SYSTEM PROMPT ###
+You are summarizing the beginning of a tutoring session between a student and an AI tutor, so that the tutor can keep helping the student without reading it all again.
+
+### SUMMARY OF WHAT CAME BEFORE ###
+{previous}
+
+### CONVERSATION TO ADD TO THE SUMMARY ###
+{span}
+
+### SYSTEM PROMPT ###
+Write an updated summary covering both the summary of what came before and the conversation to add. Keep the subject, the level of the student, the topics already taught and asked about, what the student understood or struggled with, and any open question. Do NOT answer the student. Return only the summary, in at most 300 words."""
+
+
+def summarize_span(previous: str, span: str) -> str:
+    """Writes the rolling summary of a span of the conversation, for ContextBudget."""
+    prompt = SUMMARY_PROMPT.format(previous=previous or "(Nothing, this is the start of the session.)", span=span)
+    model = model_registry.get("summary")
+    summary, _ = response_cache.get_or_compute(
+        model.model_id,
+        model.kwargs.get("temperature"),
+        prompt,
+        lambda: model(messages=[{"role": "user", "content": prompt}]).content,
     )
+    return summary
 
 
 def translate_json(body: list[dict]) -> list[dict]:
@@ -297,12 +611,12 @@ if __name__ == "__main__":
         "This module is not meant to be run directly. Please use the API endpoints to interact with the agent."
     )
     # Example usage
-    body = {
-        0: {"balise": "question", "content": "What would you like to work on today?"},
-        1: {
-            "balise": "user",
-            "content": "I'm working on Markov Chains but I'm doing well! I'd love to work on them a bit to refresh my memory.",
-        },
-    }
-    init_agent([])
-    print(run_agent(body))
+    document = DocumentContext()
+    document.set_block(0, "What would you like to work on today?", "question")
+    document.set_block(
+        1,
+        "I'm working on Markov Chains but I'm doing well! I'd love to work on them a bit to refresh my memory.",
+        USER_RESPONSE_BALISE,
+    )
+    agent = init_agent([])
+    print(run_agent(agent, document))
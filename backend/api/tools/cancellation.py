@@ -0,0 +1,104 @@
+# /usr/bin/python3
+import threading
+from contextlib import contextmanager
+from typing import Callable
+
+"""
+Cooperative cancellation of agent runs.
+
+Each agent run gets a CancellationToken, cancelled when a newer submission of
+the session makes its answer stale (see SessionStore.submit). The run checks
+its token between manager steps, before tool calls and between streamed
+tokens, and raises CancelledRun as soon as it is cancelled. The model calls of
+a cancellable run are all streamed (question check, router, manager and
+writers), so a cancelled call is closed at its next chunk; only the wait for
+its first chunk cannot be interrupted. Callbacks
+registered on the token, such as CodeAgent.interrupt, stop the agents running
+for it. Speculative runs and prefetches use their own tokens.
+"""
+
+
+class CancelledRun(Exception):
+    """Raised in a run whose token was cancelled."""
+
+
+class CancellationToken:
+    """
+    Cancellation flag of a run.
+
+    Args:
+        parent (CancellationToken): Token whose cancellation also cancels this one, if any.
+    """
+
+    def __init__(self, parent: "CancellationToken" = None):
+        self._cancelled = threading.Event()
+        self._callbacks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._detach = parent.on_cancel(self.cancel) if parent is not None else (lambda: None)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Registers a callback called once on cancellation, right away if already cancelled.
+
+        Returns:
+            Callable: Unregisters the callback.
+        """
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def detach(self):
+        """Stops following the parent's cancellation, so that the parent does not keep this token alive."""
+        self._detach()
+
+    def _remove(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """Raises CancelledRun if the token was cancelled."""
+        if self._cancelled.is_set():
+            raise CancelledRun("Run cancelled")
+
+
+# Token of the run in progress in the current thread
+_current = threading.local()
+
+
+def current_token() -> CancellationToken | None:
+    return getattr(_current, "token", None)
+
+
+@contextmanager
+def cancellable(token: CancellationToken):
+    """Makes the token the one of the run in progress in the current thread within the block."""
+    previous = current_token()
+    _current.token = token
+    try:
+        yield token
+    finally:
+        _current.token = previous
+
+
+def check_cancelled():
+    """Raises CancelledRun if the run in progress in the current thread was cancelled."""
+    token = current_token()
+    if token is not None:
+        token.check()
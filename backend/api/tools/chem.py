@@ -2,8 +2,27 @@
 from smolagents.tools import Tool
 from rdkit import Chem
 from rdkit.Chem import Draw
+import sys
 import uuid
 
+from .render_pool import render_pool
+
+"""
+Molecule drawing tool of the agents.
+
+Imported relatively, so to draw a molecule by hand run it as a module from backend/:
+python -m api.tools.chem <SMILES> [output.png]
+"""
+
+
+def draw_molecule(formula: str, output_path: str) -> str:
+    """Draws a molecule to a PNG file, run on a render worker."""
+    mol = Chem.MolFromSmiles(formula)
+    if mol is None:
+        raise ValueError("Invalid chemical formula (SMILES) provided.")
+    Draw.MolToFile(mol, output_path)
+    return output_path
+
 
 class MoleculeImageTool(Tool):
     name = "molecule_image"
@@ -28,8 +47,9 @@ class MoleculeImageTool(Tool):
         if output_path is None:
             unique_id = str(uuid.uuid4())
             output_path = f"devenv/static/plots/molecule_{unique_id}.png"
-        mol = Chem.MolFromSmiles(formula)
-        if mol is None:
-            raise ValueError("Invalid chemical formula (SMILES) provided.")
-        Draw.MolToFile(mol, output_path)
-        return output_path
+        # Drawing is CPU-bound, it runs on the render pool like plots
+        return render_pool.run(draw_molecule, formula, output_path)
+
+
+if __name__ == "__main__":
+    print(MoleculeImageTool().forward(*sys.argv[1:3]))
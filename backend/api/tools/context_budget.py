@@ -0,0 +1,157 @@
+# /usr/bin/python3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from typing import Callable
+
+from .document import DocumentContext, count_tokens, render_message
+from .session_logs import logger
+
+"""
+Token budget of the context sent to the LLMs.
+
+While a document fits in the budget it is sent as is. Past that, the most
+recent runs of the document are kept verbatim and the older ones are replaced
+by a rolling summary. Older runs are grouped into spans of about SPAN_TOKENS
+tokens, and the summary of a span is written from the summary of the spans
+before it, so each new span costs a single summarization of bounded size and
+the prompt stays roughly the same size however long the session gets.
+
+Summaries are written in the background: a request never waits for one. Until
+the summary of a span is ready, the span is sent verbatim, truncated from the
+start if it does not fit.
+"""
+
+CONTEXT_MAX_TOKENS = int(getenv("CONTEXT_MAX_TOKENS", 8000))  # Budget of the document part of the prompt
+RECENT_SHARE = 0.5  # Share of the budget kept for recent runs, verbatim
+SPAN_TOKENS = 1500  # Size of the spans of older runs summarized together
+SUMMARY_WORKERS = 2
+
+SUMMARY_ROLE = "summary of the earlier conversation"
+
+_summarizers = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summarizer")
+
+
+class _Span:
+    """Consecutive older runs summarized together, with the rolling summary up to them."""
+
+    __slots__ = ("runs", "summary")
+
+    def __init__(self, runs: list):
+        self.runs = runs
+        self.summary = None  # Summary of this span and all the spans before it
+
+
+class ContextBudget:
+    """
+    Fits the document of a session in a token budget.
+
+    Args:
+        summarize (Callable): Writes the summary of a span of the conversation, given
+            the summary of what came before it (empty for the first span) and the span.
+        max_tokens (int): Budget of the rendered document.
+    """
+
+    def __init__(self, summarize: Callable[[str, str], str], max_tokens: int = CONTEXT_MAX_TOKENS):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self._spans: list[_Span] = []
+        self._pending = False  # Whether summaries are being written in the background
+        self._lock = threading.Lock()
+
+    def render(self, document: DocumentContext, reserved: int = 0) -> str:
+        """
+        Renders the document within the budget.
+
+        Args:
+            document (DocumentContext): The document to render.
+            reserved (int): Tokens of the budget already used by the rest of the prompt.
+        """
+        budget = max(self.max_tokens - reserved, 0)
+        if document.tokens <= budget:
+            return document.render()
+
+        # Keep the most recent runs verbatim, at least the last one
+        runs = document.runs()
+        recent = len(runs) - 1
+        used = runs[recent].tokens
+        while recent > 0 and used + runs[recent - 1].tokens <= RECENT_SHARE * budget:
+            recent -= 1
+            used += runs[recent].tokens
+
+        with self._lock:
+            spans, open_runs = self._update_spans(runs[:recent])
+            ready = 0
+            while ready < len(spans) and spans[ready].summary is not None:
+                ready += 1
+            if ready < len(spans) and not self._pending:
+                self._pending = True
+                _summarizers.submit(self._summarize_spans)
+            summary = spans[ready - 1].summary if ready else ""
+
+        parts = []
+        if summary:
+            parts.append(render_message(SUMMARY_ROLE, summary))
+            used += count_tokens(summary)
+        # Older runs not summarized yet, truncated from the start to fit
+        older = [run.rendered for span in spans[ready:] for run in span.runs]
+        older += [run.rendered for run in open_runs]
+        room = max(budget - used, 0) * 4  # In characters
+        if older and room:
+            older = "\n".join(older)
+            if len(older) > room:
+                older = "[...]\n" + older[len(older) - room :]
+            parts.append(older)
+        parts.extend(run.rendered for run in runs[recent:])
+        return "\n".join(parts)
+
+    def _update_spans(self, older: list) -> tuple[list[_Span], list]:
+        """
+        Groups the older runs into full spans, reusing the spans (and their summaries)
+        whose runs did not change. Returns the spans and the runs of the last,
+        incomplete span, which are not summarized yet.
+        """
+        kept = 0
+        position = 0
+        for span in self._spans:
+            # Runs are replaced when their blocks change, so identity means unchanged
+            end = position + len(span.runs)
+            if end > len(older) or any(a is not b for a, b in zip(span.runs, older[position:end])):
+                break
+            kept += 1
+            position = end
+        if kept < len(self._spans):
+            logger.debug("Older blocks changed, dropping %d summarized spans", len(self._spans) - kept)
+            del self._spans[kept:]
+
+        start = position
+        tokens = 0
+        for index in range(position, len(older)):
+            tokens += older[index].tokens
+            if tokens >= SPAN_TOKENS:
+                self._spans.append(_Span(older[start : index + 1]))
+                start = index + 1
+                tokens = 0
+        return self._spans, older[start:]
+
+    def _summarize_spans(self):
+        """Writes the missing rolling summaries, oldest span first, until none is missing."""
+        try:
+            while True:
+                with self._lock:
+                    index = next(
+                        (index for index, span in enumerate(self._spans) if span.summary is None), None
+                    )
+                    if index is None:
+                        return
+                    span = self._spans[index]
+                    previous = self._spans[index - 1].summary if index else ""
+                summary = self.summarize(previous, "\n".join(run.rendered for run in span.runs))
+                with self._lock:
+                    # Harmless if the span was dropped meanwhile because older blocks changed
+                    span.summary = summary
+        except Exception as e:
+            logger.error("Summarization failed: %s", e)
+        finally:
+            with self._lock:
+                self._pending = False
@@ -1,5 +1,13 @@
 # /usr/bin/python3
-from smolagents import LiteLLMModel, ChatMessage
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from os import getenv
+
+from .session_logs import logger
 
 """
 We build the context for the Manager agent from the body of the document.
@@ -11,10 +19,21 @@ User state estimator: Estimates what help the user might want, if he doesn't und
 Important points extractor: Extracts important points from the document, such as the main topic, step-by-step key points of the document.
 
 Algorithmic context extractor: Extracts the last words of the document, which are likely to be the most relevant for the user.
+
+The user state estimation is started on a thread pool as soon as a manager run
+is: with the manager, or with the speculative manager run alongside the question
+check. Question turns without a manager run do not estimate it. The manager
+then waits for it at most until a strict deadline, and goes without it past
+that. Estimations are cached by context hash, and an estimation finishing after
+its deadline is still cached for the next identical context.
 """
 
 # TODO for now we get the whole context and juste "user state estimator"
 
+USER_STATE_DEADLINE = float(getenv("USER_STATE_DEADLINE", 4.0))  # Seconds after the start of the estimation
+USER_STATE_CACHE_SIZE = 1024
+USER_STATE_WORKERS = 4
+
 USER_STATE_ESTIMATOR_SYSTEM_PROMPT = """You are an AI model that analyzes the interaction between a user and an AI tutor. Your task is to determine the global state of the user with respect to the problem they are working on. This includes evaluating their overall understanding, confidence level, and any misconceptions they may have.
 
 The context you receive contains both the problem the user is working on and the full interaction between the user and the assistant. Based on this, you must infer why, how and whether they have a correct understanding or are struggling.
@@ -28,47 +47,86 @@ You should NOT answer the questions asked by the user, you should just analyze t
 Do NOT ask questions to the User. Answer by saying "the user..." instead of "you...". You are talking to another ChatBot, not to the user. This model needs to have information from you. You cannot ask questions at all. If you don't know how to provide analysis, say so and stop generating."""
 
 
-def build_context(body: list[dict]) -> list[dict]:
+_estimators = ThreadPoolExecutor(max_workers=USER_STATE_WORKERS, thread_name_prefix="user-state")
+_cache: OrderedDict[str, str] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class UserStateEstimate:
+    """User state estimation in progress, with the deadline after which it is ignored."""
+
+    def __init__(self, future: Future, deadline: float):
+        self.future = future
+        self.deadline = deadline
+
+    def result(self) -> str | None:
+        """Waits for the estimation until the deadline, returns None if it is not ready by then."""
+        try:
+            return self.future.result(timeout=max(self.deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            logger.warning("User state estimation missed its deadline, going without it.")
+        except Exception as e:
+            logger.error("User state estimation failed: %s", e)
+        return None
+
+    def cancel(self):
+        """Drops the estimation if it has not started yet."""
+        self.future.cancel()
+
+
+def start_user_state(context: str, deadline: float = USER_STATE_DEADLINE) -> UserStateEstimate:
+    """Starts estimating the user state in the background, reusing the estimation of an identical context."""
+    key = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    with _cache_lock:
+        state = _cache.get(key)
+        if state is not None:
+            _cache.move_to_end(key)
+    if state is not None:
+        future = Future()
+        future.set_result(state)
+    else:
+        future = _estimators.submit(user_state_estimator, context)
+        future.add_done_callback(lambda done: _store(key, done))
+    return UserStateEstimate(future, time.monotonic() + deadline)
+
+
+def _store(key: str, future: Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    with _cache_lock:
+        _cache[key] = future.result()
+        while len(_cache) > USER_STATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def build_context(context: str, user_state: UserStateEstimate) -> str:
     """
-    Builds the context for the Manager agent from the body of the document.
+    Builds the context for the Manager agent from the context of the document.
 
     Args:
-        body (dict): The body of the document, i.e. :[{role="fixedquestion", content="What would you like to work on today?"}, {role="user", content="I'm working on Markov Chains."}].
+        context (str): The rendered context, i.e. "### assistant ###\nWhat would you like to work on today?\n\n### user ###\nI'm working on Markov Chains.\n".
+        user_state (UserStateEstimate): The estimation started by start_user_state.
 
     Returns:
-        dict: The built context for the Manager agent.
+        str: The built context for the Manager agent, with the user state if it was estimated in time.
     """
-    raise NotImplementedError(
-        "This function is not implemented yet. Please implement it in the future."
-    )
-    return_body = body
-    return_body[-1]["content"] = (
-        "### ORIGINAL USER PROMPT ###\n"
-        + body[-1]["content"]
-        + "\n### SENTIMENT ANALYSIS RESULT ###\n"
-        + user_state_estimator(body).content
-    )
-    return return_body
+    state = user_state.result()
+    if not state:
+        return context
+    return context + "\n### USER STATE ANALYSIS ###\n" + state + "\n"
 
 
-def user_state_estimator(body: list[dict]) -> ChatMessage:
-    # Call a Claude LLM
-    # load api_key from ./api_key.txt
-    # with open("./api_key.txt", "r") as f:
-    #     key = f.read().strip()
-    key = ...
-    model = LiteLLMModel(
-        model_id="claude-3-5-haiku-latest", temperature=0.3, max_tokens=300, api_key=key
-    )
-    add_prompt = body
-    add_prompt[-1]["content"] = last_content_prompted(body)
-    return model.generate(add_prompt)
+def user_state_estimator(context: str) -> str:
+    from .agent import model_registry
 
+    model = model_registry.get("user_state")
+    return model(messages=[{"role": "user", "content": last_content_prompted(context)}]).content
 
-def last_content_prompted(body):
+
+def last_content_prompted(context: str) -> str:
     return (
         "### ORIGINAL USER PROMPT ###\n"
-        + body[-1]["content"]
+        + context
         + "\n### SYSTEM PROMPT ###\n"
         + USER_STATE_ESTIMATOR_SYSTEM_PROMPT
     )
@@ -76,13 +134,10 @@ def last_content_prompted(body):
 
 if __name__ == "__main__":
     # Example usage
-    body = [
-        {"role": "assistant", "content": "What would you like to work on today?"},
-        {"role": "user", "content": "I'm working on Markov Chains"},
-        {"role": "assistant", "content": "Do you need help?"},
-        {
-            "role": "user",
-            "content": "Yes, I get what Markov Chains are, but I don't understand how to calculate the transition matrix from a description...",
-        },
-    ]
-    print(build_context(body))
+    context = (
+        "### assistant ###\nWhat would you like to work on today?\n\n"
+        "### user ###\nI'm working on Markov Chains\n\n"
+        "### assistant ###\nDo you need help?\n\n"
+        "### user ###\nYes, I get what Markov Chains are, but I don't understand how to calculate the transition matrix from a description...\n"
+    )
+    print(build_context(context, start_user_state(context)))
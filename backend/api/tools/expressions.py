@@ -0,0 +1,279 @@
+# /usr/bin/python3
+import ast
+import io
+import tokenize
+from functools import lru_cache
+
+import numpy as np
+
+"""
+Sandboxed compiler for the mathematical expressions of function plots.
+
+An expression in terms of x is parsed once to a Python AST, checked against a
+whitelist of nodes and names, and compiled to a vectorized NumPy function that
+is cached. Besides the usual operators, expressions support:
+
+- '^' for powers: x^2
+- Implicit multiplication: 2x, 3sin(x), (x+1)(x-1), 2pi x
+- Piecewise definitions with conditional expressions: x^2 if x < 0 else sqrt(x),
+  using comparisons and 'and', 'or', 'not'
+"""
+
+COMPILE_CACHE_SIZE = 512
+
+# Mathematical functions and constants allowed in expressions
+FUNCTIONS = {
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "exp": np.exp,
+    "log": np.log10,  # Base 10 logarithm
+    "ln": np.log,  # Natural logarithm (base e)
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "arcsin": np.arcsin,
+    "arccos": np.arccos,
+    "arctan": np.arctan,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+}
+CONSTANTS = {
+    "pi": np.pi,
+    "e": np.e,
+}
+VARIABLE = "x"
+
+_ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Call,
+    ast.Name,
+    ast.Attribute,
+    ast.Constant,
+    ast.Load,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+    ast.Not,
+    ast.And,
+    ast.Or,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Eq,
+    ast.NotEq,
+)
+_KEYWORDS = {"if", "else", "and", "or", "not"}
+
+
+class ExpressionError(ValueError):
+    """Raised when an expression is invalid or uses something outside the whitelist."""
+
+
+class CompiledExpression:
+    """
+    Vectorized function compiled from an expression.
+
+    Attributes:
+        source (str): Canonical form of the expression, identical for expressions
+            differing only in layout.
+    """
+
+    def __init__(self, source: str, function):
+        self.source = source
+        self._function = function
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        # Out of domain values (sqrt(-1), 1/0...) become NaN or inf instead of warnings
+        with np.errstate(all="ignore"):
+            y = np.asarray(self._function(x), dtype=float)
+        if y.shape != x.shape:
+            # Constant expressions, e.g. f(x) = 3
+            y = np.broadcast_to(y, x.shape).copy()
+        return y
+
+
+def insert_implicit_multiplications(text: str) -> str:
+    """Makes implicit multiplications explicit, e.g. '2x(x+1)' becomes '2*x*(x+1)'."""
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    except (tokenize.TokenError, SyntaxError) as e:
+        raise ExpressionError(f"Invalid expression: {e}")
+
+    result = []
+    previous = None
+    attribute = False  # Whether the previous token is the name of an attribute, e.g. np.sin
+    for token in tokens:
+        if token.type == tokenize.ERRORTOKEN and not token.string.isspace():
+            raise ExpressionError(f"Invalid character '{token.string}' in expression")
+        if previous is not None and _ends_operand(previous) and _starts_operand(token):
+            # A function name followed by '(' is a call, not a product
+            if not (token.string == "(" and (previous.string in FUNCTIONS or attribute)):
+                result.append((tokenize.OP, "*"))
+        result.append((token.type, token.string))
+        if token.type not in (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER):
+            attribute = previous is not None and previous.string == "." and token.type == tokenize.NAME
+            previous = token
+    return tokenize.untokenize(result).strip()
+
+
+def _ends_operand(token) -> bool:
+    if token.type == tokenize.NUMBER or token.string == ")":
+        return True
+    return token.type == tokenize.NAME and token.string not in _KEYWORDS
+
+
+def _starts_operand(token) -> bool:
+    if token.string == "(":
+        return True
+    return token.type == tokenize.NAME and token.string not in _KEYWORDS
+
+
+class _Validator(ast.NodeVisitor):
+    """Rejects every node and name that is not explicitly allowed."""
+
+    def generic_visit(self, node):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ExpressionError(f"'{type(node).__name__}' is not allowed in expressions")
+        super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+            raise ExpressionError(f"Invalid constant {node.value!r}")
+
+    def visit_Name(self, node):
+        if node.id != VARIABLE and node.id not in CONSTANTS:
+            if node.id in FUNCTIONS:
+                raise ExpressionError(f"Function '{node.id}' must be called, e.g. {node.id}(x)")
+            raise ExpressionError(f"Unknown name '{node.id}'")
+
+    def visit_Attribute(self, node):
+        # Kept for expressions written with numpy, e.g. np.sin(x) or np.pi
+        value = getattr(np, node.attr, None)
+        if not (
+            isinstance(node.value, ast.Name)
+            and node.value.id == "np"
+            and (isinstance(value, np.ufunc) or node.attr in CONSTANTS)
+        ):
+            raise ExpressionError(f"Unknown name '{ast.unparse(node)}'")
+
+    def visit_Call(self, node):
+        if node.keywords or len(node.args) != 1:
+            raise ExpressionError(f"'{ast.unparse(node.func)}' takes a single argument")
+        if isinstance(node.func, ast.Name):
+            if node.func.id not in FUNCTIONS:
+                raise ExpressionError(f"Unknown function '{node.func.id}'")
+        else:
+            self.visit(node.func)
+        for arg in node.args:
+            self.visit(arg)
+
+
+class _Vectorizer(ast.NodeTransformer):
+    """Rewrites conditionals and boolean logic into their element-wise NumPy versions."""
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return _call("_where", node.test, node.body, node.orelse)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        # a < b < c is (a < b) and (b < c)
+        comparisons = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            comparisons.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        return _reduce("_and", comparisons)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        return _reduce("_and" if isinstance(node.op, ast.And) else "_or", node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return _call("_not", node.operand)
+        return node
+
+    def visit_Constant(self, node):
+        # Float arithmetic overflows instead of building huge integers, e.g. 9^9^9
+        return ast.Constant(value=float(node.value))
+
+
+def _call(name: str, *args) -> ast.Call:
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=list(args), keywords=[])
+
+
+def _reduce(name: str, values: list) -> ast.AST:
+    result = values[0]
+    for value in values[1:]:
+        result = _call(name, result, value)
+    return result
+
+
+_NAMESPACE = {
+    "__builtins__": {},
+    "np": np,
+    "_where": np.where,
+    "_and": np.logical_and,
+    "_or": np.logical_or,
+    "_not": np.logical_not,
+    **FUNCTIONS,
+    **CONSTANTS,
+}
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_expression(text: str) -> CompiledExpression:
+    """
+    Compiles an expression in terms of x to a cached vectorized function.
+
+    Args:
+        text (str): The expression, e.g. '2x^2 + sin(x)'.
+
+    Returns:
+        CompiledExpression: The compiled function, called with an array of x values.
+
+    Raises:
+        ExpressionError: If the expression is invalid or not allowed.
+    """
+    source = insert_implicit_multiplications(text.replace("^", "**"))
+    try:
+        tree = ast.parse(source, mode="eval")
+        _Validator().visit(tree)
+        canonical = ast.unparse(tree)
+
+        body = _Vectorizer().visit(tree).body
+        function = ast.Expression(
+            body=ast.Lambda(
+                args=ast.arguments(
+                    posonlyargs=[],
+                    args=[ast.arg(arg=VARIABLE)],
+                    kwonlyargs=[],
+                    kw_defaults=[],
+                    defaults=[],
+                ),
+                body=body,
+            )
+        )
+        ast.fix_missing_locations(function)
+        code = compile(function, "<expression>", "eval")
+    except SyntaxError as e:
+        raise ExpressionError(f"Invalid expression: {e.msg}")
+    except (RecursionError, MemoryError):
+        # Parsing, checking and compiling recurse on the nesting, e.g. ----x or x<x<...<x
+        raise ExpressionError("Expression is too deeply nested")
+    return CompiledExpression(canonical, eval(code, dict(_NAMESPACE)))
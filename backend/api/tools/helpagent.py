@@ -1,9 +1,16 @@
 # /usr/bin/python3
 from smolagents import CodeAgent, LiteLLMModel
-from chem import MoleculeImageTool
-from deepthinking import DeepThinkingTool
+from .chem import MoleculeImageTool
+from .deepthinking import DeepThinkingTool
 import uuid
 
+"""
+Standalone educational agent answering with a single image or question.
+
+Its tools are imported relatively, so run it as a module from backend/:
+python -m api.tools.helpagent
+"""
+
 model_id = "claude-3-haiku-20240307"
 
 agent = CodeAgent(
@@ -49,9 +56,10 @@ Gently probe if needed (e.g., "What do you already know about Louis-Philippe’s
 
 Provide Tiered Support."""
 
-# Specify the output directory for plots
-unique_id = str(uuid.uuid4())
+if __name__ == "__main__":
+    # Specify the output directory for plots
+    unique_id = str(uuid.uuid4())
 
-agent.run(
-    f"{input}",
-)
+    agent.run(
+        f"{input}",
+    )
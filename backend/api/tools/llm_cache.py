@@ -0,0 +1,247 @@
+# /usr/bin/python3
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import getenv
+from typing import Callable
+
+"""
+Content-addressed cache of LLM responses.
+
+Responses are keyed on the model ID, the temperature and a hash of the
+normalized prompt, so learners of a cohort asking for the same topic with the
+same context share a single generation. The cache has an in-memory LRU tier
+and an optional SQLite tier (enabled by setting LLM_CACHE_PATH), both with a
+TTL and size-based eviction. Concurrent identical misses wait for the first one
+instead of generating the same response in parallel.
+"""
+
+CACHE_TTL = float(getenv("LLM_CACHE_TTL", 24 * 60 * 60))
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+DISK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapses whitespace so that prompts differing only in layout share a key."""
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def cache_key(model_id: str, temperature, prompt: str) -> str:
+    digest = hashlib.sha256()
+    for part in (str(model_id), str(temperature), normalize_prompt(prompt)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """SQLite tier of the response cache."""
+
+    def __init__(self, db_path: str, max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+            )
+            # Running total of the sizes, so that puts never sum the whole table
+            self.nbytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str, ttl: float) -> str | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, created, size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.nbytes -= row[2]
+                return None
+            self._connection.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock, self._connection:
+            replaced = self._connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            total = self.nbytes + size - (replaced[0] if replaced else 0)
+            # Drop least recently used responses until under budget
+            while total > self.max_bytes:
+                row = self._connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+                ).fetchone()
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                total -= row[1]
+            self.nbytes = total
+
+
+class ResponseCache:
+    """
+    Two-tier cache of LLM responses.
+
+    Args:
+        max_entries (int): Maximum number of responses in memory.
+        max_bytes (int): Maximum total size of the responses in memory.
+        ttl (float): Seconds after which a response expires.
+        db_path (str): Path of the SQLite database of the disk tier, None to disable it.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ttl: float = CACHE_TTL,
+        db_path: str = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = DiskCache(db_path) if db_path else None
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._pending: dict[str, Future] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached response, or None. Does not count as a hit or a miss."""
+        with self._lock:
+            value = self._get_memory(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key, self.ttl)
+            if value is not None:
+                with self._lock:
+                    self._put_memory(key, value)
+        return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._put_memory(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def get_or_compute(
+        self, model_id: str, temperature, prompt: str, compute: Callable[[], str]
+    ) -> tuple[str, bool]:
+        """
+        Returns the cached response to the prompt, computing and caching it on a miss.
+
+        Returns:
+            tuple[str, bool]: The response, and whether it came from the cache.
+        """
+        key = cache_key(model_id, temperature, prompt)
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                self.hits += 1
+                return value, True
+            pending = self._pending.get(key)
+            if pending is None:
+                future = self._pending[key] = Future()
+
+        if pending is not None:
+            # An identical request is already generating this response
+            try:
+                value = pending.result()
+            except Exception:
+                # Its run failed or was cancelled, which does not concern this one
+                return self.get_or_compute(model_id, temperature, prompt, compute)
+            with self._lock:
+                self.hits += 1
+            return value, True
+
+        try:
+            value = self.disk.get(key, self.ttl) if self.disk is not None else None
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, value)
+                future.set_result(value)
+                return value, True
+
+            with self._lock:
+                self.misses += 1
+            value = compute()
+            if value:
+                self.put(key, value)
+            future.set_result(value)
+            return value, False
+        except BaseException as e:
+            # Unregistered first, so that the waiters retrying do not find it again
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _get_memory(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _put_memory(self, key: str, value: str):
+        self._remove(key)
+        self._entries[key] = (value, time.time())
+        self.nbytes += len(value)
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self.nbytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[0])
+
+
+response_cache = ResponseCache(db_path=getenv("LLM_CACHE_PATH") or None)
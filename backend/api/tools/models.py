@@ -0,0 +1,88 @@
+# /usr/bin/python3
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator
+
+if TYPE_CHECKING:
+    from smolagents import CodeAgent, LiteLLMModel
+
+"""
+Process-wide LLM clients and agents.
+
+ModelRegistry builds each LiteLLMModel once, on first use, and shares it
+between all sessions, so its settings and HTTP connections are reused instead
+of being rebuilt on every /api/init. CodeAgents keep their step memory while
+they run, so they cannot be shared by concurrent requests: AgentPool lends
+each run its own agent and takes it back afterwards for the next run.
+
+smolagents is only imported when the first model is built, to keep the import
+of this module cheap.
+"""
+
+AGENT_POOL_MAX_IDLE = 8  # Idle agents kept per pool
+
+
+class ModelRegistry:
+    """
+    Lazily built, shared LLM clients.
+
+    Args:
+        specs (dict): LiteLLMModel arguments (model_id, temperature...) of each model name.
+        api_key (str): API key given to every model.
+    """
+
+    def __init__(self, specs: dict[str, dict], api_key: str):
+        self.specs = specs
+        self.api_key = api_key
+        self._models: dict[str, "LiteLLMModel"] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> "LiteLLMModel":
+        from smolagents import LiteLLMModel
+
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._models[name] = LiteLLMModel(**self.specs[name], api_key=self.api_key)
+            return model
+
+
+class AgentPool:
+    """
+    Pool of interchangeable CodeAgents, lent to one run at a time.
+
+    Args:
+        factory (Callable): Builds a new agent when none is idle.
+        max_idle (int): Maximum number of idle agents kept for reuse.
+    """
+
+    def __init__(self, factory: Callable[[], "CodeAgent"], max_idle: int = AGENT_POOL_MAX_IDLE):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle: list["CodeAgent"] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self) -> Iterator["CodeAgent"]:
+        """Lends an agent for the duration of the with block."""
+        with self._lock:
+            agent = self._idle.pop() if self._idle else None
+        if agent is None:
+            agent = self.factory()
+            with self._lock:
+                self.created += 1
+        try:
+            yield agent
+        finally:
+            self.checkin(agent)
+
+    def checkin(self, agent: "CodeAgent"):
+        # Agents reset their memory at the start of each run, so they can be reused as is
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(agent)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"idle": len(self._idle), "created": self.created}
@@ -1,97 +1,76 @@
 # /usr/bin/python3
 from flask import jsonify
 import re
-import numpy as np
-import matplotlib
-
-matplotlib.use("Agg")  # Must be set before importing pyplot
-import matplotlib.pyplot as plt
-import io
 import base64
+import hashlib
+import math
+from functools import lru_cache
 
+from .expressions import compile_expression, ExpressionError
+from .render_pool import render_pool, RenderPoolFullError, RenderTimeoutError
+from .sampling import sample_function, sample_functions, overlay_view
 
-def plot_function(function_str, x_min, x_max):
-    """
-    Plot a mathematical function given as a string.
-    Assumes the expr is a valid mathematical expression in terms of x.
-    """
+
+PLOT_CACHE_SIZE = 256  # Number of rendered plots kept in memory
+PLOT_RENDER_VERSION = "2"  # Bump when the rendering changes, to invalidate ETags
+MAX_BATCH_FUNCTIONS = 8
+
+
+class PlotError(ValueError):
+    """Raised when a function cannot be plotted."""
+
+
+def parse_function(function_str) -> str:
+    """Extracts the normalized right-hand side of a 'f(x) = ...' function string."""
     # Validate function string
     if not function_str or not isinstance(function_str, str):
-        return jsonify({"error": "Invalid function format. Use f(x) = ..."}), 400
-    # Validate x range
-    if x_min >= x_max:
-        return jsonify({"error": "x_min must be less than x_max"}), 400
+        raise PlotError("Invalid function format. Use f(x) = ...")
 
     # Extract the right-hand side of the equation
     match = re.search(r"f\(x\)\s*=\s*(.+)", function_str)
     if not match:
-        return jsonify({"error": "Invalid function format. Use f(x) = ..."}), 400
-
-    expr = match.group(1).strip()
-
-    # Create x values
-    x = np.linspace(x_min, x_max, 1000)
-
-    # Create a new figure with a dark background
-    plt.style.use("dark_background")
-    fig, ax = plt.subplots(figsize=(10, 6))
-
-    # Replace common math operations with numpy equivalents
-    expr = expr.replace("^", "**")
-
-    # Create evaluation context with mathematical functions and constants
-    eval_context = {
-        "np": np,
-        "x": x,
-        "sin": np.sin,
-        "cos": np.cos,
-        "tan": np.tan,
-        "exp": np.exp,
-        "log": np.log10,  # Base 10 logarithm
-        "ln": np.log,  # Natural logarithm (base e)
-        "sqrt": np.sqrt,
-        "pi": np.pi,
-        "e": np.e,
-        "abs": np.abs,
-        "arcsin": np.arcsin,
-        "arccos": np.arccos,
-        "arctan": np.arctan,
-        "sinh": np.sinh,
-        "cosh": np.cosh,
-        "tanh": np.tanh,
-    }
-
-    # Evaluate the function
+        raise PlotError("Invalid function format. Use f(x) = ...")
+
+    # Parse once, the compiled expression is cached and its source is canonical
     try:
-        y = eval(expr, eval_context)
-    except Exception as e:
-        return jsonify({"error": f"Error evaluating function: {str(e)}"}), 400
+        return compile_expression(match.group(1).strip()).source
+    except ExpressionError as e:
+        raise PlotError(str(e))
 
-    # Plot the function
-    ax.plot(x, y, color="#FFD246", linewidth=2)
 
-    # Add x=0 and y=0 lines
-    ax.axhline(y=0, color="skyblue", linestyle="-", linewidth=1, alpha=0.8)
-    ax.axvline(x=0, color="skyblue", linestyle="-", linewidth=1, alpha=0.8)
+def plot_etag(function_str, x_min, x_max) -> str | None:
+    """
+    Returns the ETag of the plot of a function, without rendering it.
+    Plots are deterministic, so the ETag only depends on the normalized function and range.
+    """
+    try:
+        expr = parse_function(function_str)
+    except PlotError:
+        return None
+    key = f"{PLOT_RENDER_VERSION}|{expr}|{float(x_min)!r}|{float(x_max)!r}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
-    # Customize the plot
-    ax.grid(True, alpha=0.2, linestyle="--")
-    ax.set_title("Function Plot", color="white")
-    ax.set_xlabel("x", color="white")
-    ax.set_ylabel("f(x)", color="white")
 
-    # Set the background color
-    fig.patch.set_facecolor("#18192A")
-    ax.set_facecolor("#18192A")
+def plot_function(function_str, x_min, x_max):
+    """
+    Plot a mathematical function given as a string.
+    The expression is compiled by the sandboxed expression engine, see expressions.py.
+    """
+    # Validate x range
+    if x_min >= x_max:
+        return jsonify({"error": "x_min must be less than x_max"}), 400
 
-    # Save the plot to a bytes buffer
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", facecolor="#18192A")
-    buf.seek(0)
-    plt.close()
+    try:
+        png = render_plot(parse_function(function_str), float(x_min), float(x_max))
+    except PlotError as e:
+        return jsonify({"error": str(e)}), 400
+    except RenderPoolFullError as e:
+        return jsonify({"error": str(e)}), 503
+    except RenderTimeoutError as e:
+        return jsonify({"error": str(e)}), 504
 
     # Convert the image to base64
-    image_base64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+    image_base64 = base64.b64encode(png).decode("utf-8")
 
     # Return the base64-encoded image
     return jsonify(
@@ -100,3 +79,114 @@ def plot_function(function_str, x_min, x_max):
             "text": f"data:image/png;base64,{image_base64}",
         }
     )
+
+
+@lru_cache(maxsize=PLOT_CACHE_SIZE)
+def render_plot(expr: str, x_min: float, x_max: float) -> bytes:
+    """Renders the plot of a normalized expression to PNG bytes, caching the result."""
+    # Sample the function adaptively, with breaks at poles and discontinuities
+    try:
+        x, y, ylim = sample_function(compile_expression(expr), x_min, x_max)
+    except Exception as e:
+        raise PlotError(f"Error evaluating function: {str(e)}")
+
+    return render_pool.render([(x, y)], ylim)
+
+
+def parse_bounds(data: dict) -> tuple[float, float]:
+    """Parses the xMin and xMax of a plot request, which must be finite numbers with xMin < xMax."""
+    try:
+        x_min = float(data.get("xMin", 0))
+        x_max = float(data.get("xMax", 1))
+    except (TypeError, ValueError):
+        raise PlotError("xMin and xMax must be numbers")
+    if not (math.isfinite(x_min) and math.isfinite(x_max)):
+        raise PlotError("xMin and xMax must be finite")
+    if x_min >= x_max:
+        raise PlotError("x_min must be less than x_max")
+    return x_min, x_max
+
+
+def parse_batch(functions) -> tuple[tuple[str, float, float], ...]:
+    """
+    Parses the functions of a batch plot request.
+
+    Args:
+        functions (list[dict]): The functions, as {"text": "f(x) = ...", "xMin": ..., "xMax": ...}.
+
+    Returns:
+        tuple: The (normalized expression, x_min, x_max) of each function.
+    """
+    if not isinstance(functions, list) or len(functions) == 0:
+        raise PlotError("Expected a non-empty list of functions")
+    if len(functions) > MAX_BATCH_FUNCTIONS:
+        raise PlotError(f"At most {MAX_BATCH_FUNCTIONS} functions can be plotted at once")
+
+    items = []
+    for index, function in enumerate(functions):
+        try:
+            x_min, x_max = parse_bounds(function)
+            items.append((parse_function(function.get("text", "")), x_min, x_max))
+        except (PlotError, TypeError, ValueError, AttributeError) as e:
+            raise PlotError(f"Function {index + 1}: {str(e)}")
+    return tuple(items)
+
+
+def batch_etag(items: tuple[tuple[str, float, float], ...], overlay: bool) -> str:
+    key = f"{PLOT_RENDER_VERSION}|{overlay}|" + "|".join(
+        f"{expr}|{x_min!r}|{x_max!r}" for expr, x_min, x_max in items
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def plot_batch(items: tuple[tuple[str, float, float], ...], overlay: bool):
+    """
+    Plots several parsed functions, either overlaid on one figure or as one image each.
+    """
+    try:
+        images = render_batch(items, overlay)
+    except PlotError as e:
+        return jsonify({"error": str(e)}), 400
+    except RenderPoolFullError as e:
+        return jsonify({"error": str(e)}), 503
+    except RenderTimeoutError as e:
+        return jsonify({"error": str(e)}), 504
+
+    responses = [
+        {
+            "balise": "media_image",
+            "text": f"data:image/png;base64,{base64.b64encode(png).decode('utf-8')}",
+        }
+        for png in images
+    ]
+    if overlay:
+        return jsonify(responses[0])
+    return jsonify({"images": responses})
+
+
+@lru_cache(maxsize=PLOT_CACHE_SIZE)
+def render_batch(items: tuple[tuple[str, float, float], ...], overlay: bool) -> tuple[bytes, ...]:
+    """
+    Renders a batch of functions. Functions sharing a range are sampled together
+    over a shared grid, evaluating all of them in each vectorized pass.
+    """
+    ranges: dict[tuple[float, float], list[int]] = dict()
+    for index, (_, x_min, x_max) in enumerate(items):
+        ranges.setdefault((x_min, x_max), []).append(index)
+
+    series = [None] * len(items)
+    ylims = [None] * len(items)
+    for (x_min, x_max), indices in ranges.items():
+        try:
+            functions = [compile_expression(items[index][0]) for index in indices]
+            group_series, group_ylims = sample_functions(functions, x_min, x_max)
+        except Exception as e:
+            raise PlotError(f"Error evaluating function: {str(e)}")
+        for index, (x, y), ylim in zip(indices, group_series, group_ylims):
+            series[index] = (x, y)
+            ylims[index] = ylim
+
+    if overlay:
+        labels = [f"f(x) = {expr}" for expr, _, _ in items]
+        return (render_pool.render(series, overlay_view(series, ylims), labels),)
+    return tuple(render_pool.render([line], ylim) for line, ylim in zip(series, ylims))
@@ -0,0 +1,87 @@
+# /usr/bin/python3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import getenv
+from typing import Callable
+
+from .cancellation import CancellationToken, cancellable
+from .session_logs import log_session, logger
+
+"""
+Background prefetch of the likely next tutor turn.
+
+After a course on a topic, the next turn is very often a question on that same
+topic, and after a question, a course on it when the learner got it wrong. Once
+an answer is ready, the follow-up is written in the background and kept by the
+session, to be served as soon as the next routing decision matches it. It is
+dropped when the decision goes in another direction.
+
+Prefetches run on a small pool and are skipped when too many are already
+pending, so that they never compete with requests for long.
+"""
+
+PREFETCH_ENABLED = getenv("PREFETCH", "1") != "0"
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_PENDING = 16  # Prefetches submitted and not finished, across sessions
+
+# Balise of the likely follow-up of each balise
+FOLLOW_UPS = {"cours": "question", "question": "cours"}
+
+_prefetchers = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+_slots = threading.BoundedSemaphore(PREFETCH_MAX_PENDING)
+
+
+def normalize_topic(topic: str) -> str:
+    return " ".join(topic.casefold().split())
+
+
+class Prefetch:
+    """Follow-up answer being written in the background for a session."""
+
+    def __init__(self, balise: str, topic: str, future: Future, token: CancellationToken):
+        self.balise = balise
+        self.topic = topic
+        self.future = future
+        self.token = token
+
+    def matches(self, balise: str, topic: str) -> bool:
+        return self.balise == balise and normalize_topic(self.topic) == normalize_topic(topic)
+
+    def cancel(self):
+        # A prefetch that already started stops at its next cancellation check
+        self.future.cancel()
+        self.token.cancel()
+
+
+def start_prefetch(
+    session_id: str, balise: str, topic: str, write: Callable[[], str]
+) -> Prefetch | None:
+    """
+    Starts writing a follow-up in the background.
+
+    Args:
+        session_id (str): Session of the follow-up, to tag its logs.
+        balise (str): Balise of the follow-up, e.g. "question".
+        topic (str): Topic of the follow-up.
+        write (Callable): Writes the follow-up.
+
+    Returns:
+        Prefetch: The prefetch, or None if prefetching is disabled or too many are pending.
+    """
+    if not PREFETCH_ENABLED or not _slots.acquire(blocking=False):
+        return None
+
+    token = CancellationToken()
+
+    def run() -> str:
+        with log_session(session_id), cancellable(token):
+            logger.info("Prefetching a %s on: %s", balise, topic)
+            return write()
+
+    try:
+        future = _prefetchers.submit(run)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return Prefetch(balise, topic, future, token)
@@ -0,0 +1,223 @@
+# /usr/bin/python3
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from os import getenv
+from typing import Callable
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+"""
+Pool of plot render workers.
+
+Rendering uses the object-oriented Figure/FigureCanvasAgg API only, never the
+global pyplot state, so workers can render concurrently. Each worker thread
+owns a pre-styled PlotTemplate that is reused for every render and reset in
+between, instead of building and styling a new figure each time.
+
+Rasterizing holds the GIL, so in "process" mode (PLOT_RENDER_MODE=process) the
+workers are processes instead of threads, and CPU-heavy rendering no longer
+slows down the other requests of the server. In both modes the queue of
+pending jobs is bounded, jobs are rejected with RenderPoolFullError when it is
+full, and callers give up on a job with RenderTimeoutError after a timeout.
+"""
+
+RENDER_MODE = getenv("PLOT_RENDER_MODE", "thread")  # "thread" or "process"
+RENDER_WORKERS = int(getenv("PLOT_RENDER_WORKERS", 4))
+RENDER_TIMEOUT = float(getenv("PLOT_RENDER_TIMEOUT", 30))  # Seconds per job
+RENDER_QUEUE_SIZE = int(getenv("PLOT_RENDER_QUEUE", 32))  # Maximum pending jobs
+
+BACKGROUND_COLOR = "#18192A"
+LINE_COLORS = ["#FFD246", "#FF6B6B", "#4ADE80", "#C084FC", "#F97316", "#22D3EE"]
+AXIS_COLOR = "skyblue"
+TEXT_COLOR = "white"
+
+
+class PlotTemplate:
+    """Pre-styled figure with the look of the dark_background style, reused across renders."""
+
+    def __init__(self):
+        self.figure = Figure(figsize=(10, 6), facecolor=BACKGROUND_COLOR)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        ax = self.ax
+
+        ax.set_facecolor(BACKGROUND_COLOR)
+        for spine in ax.spines.values():
+            spine.set_color(TEXT_COLOR)
+        ax.tick_params(colors=TEXT_COLOR)
+
+        # Add x=0 and y=0 lines
+        ax.axhline(y=0, color=AXIS_COLOR, linestyle="-", linewidth=1, alpha=0.8)
+        ax.axvline(x=0, color=AXIS_COLOR, linestyle="-", linewidth=1, alpha=0.8)
+
+        # Customize the plot
+        ax.grid(True, alpha=0.2, linestyle="--", color=TEXT_COLOR)
+        ax.set_title("Function Plot", color=TEXT_COLOR)
+        ax.set_xlabel("x", color=TEXT_COLOR)
+        ax.set_ylabel("f(x)", color=TEXT_COLOR)
+
+        # Function lines, created on demand and kept hidden when unused
+        self.lines = []
+
+    def render(
+        self,
+        series: list[tuple[np.ndarray, np.ndarray]],
+        ylim: tuple[float, float] = None,
+        labels: list[str] = None,
+    ) -> bytes:
+        """
+        Renders function lines to PNG bytes.
+
+        Args:
+            series (list[tuple]): The (x, y) arrays of each line to draw, NaN values break lines.
+            ylim (tuple): The y limits of the view, None to fit the lines.
+            labels (list[str]): Legend labels of the lines, None for no legend.
+        """
+        try:
+            for index, (x, y) in enumerate(series):
+                if index == len(self.lines):
+                    color = LINE_COLORS[index % len(LINE_COLORS)]
+                    (line,) = self.ax.plot([], [], color=color, linewidth=2)
+                    self.lines.append(line)
+                self.lines[index].set_data(x, y)
+                self.lines[index].set_label(labels[index] if labels else None)
+                self.lines[index].set_visible(True)
+            if labels:
+                self.ax.legend(
+                    handles=self.lines[: len(series)],
+                    facecolor=BACKGROUND_COLOR,
+                    edgecolor=TEXT_COLOR,
+                    labelcolor=TEXT_COLOR,
+                )
+
+            self.ax.set_autoscale_on(True)
+            self.ax.relim(visible_only=True)
+            self.ax.autoscale_view()
+            if ylim is not None:
+                self.ax.set_ylim(ylim)
+
+            buf = io.BytesIO()
+            self.figure.savefig(buf, format="png", bbox_inches="tight", facecolor=BACKGROUND_COLOR)
+            return buf.getvalue()
+        finally:
+            self.reset()
+
+    def reset(self):
+        for line in self.lines:
+            line.set_data([], [])
+            line.set_visible(False)
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+
+
+# Template of the current worker thread (or process)
+_worker = threading.local()
+
+
+def render_series(
+    series: list[tuple[np.ndarray, np.ndarray]],
+    ylim: tuple[float, float] = None,
+    labels: list[str] = None,
+) -> bytes:
+    """Renders with the template of the current worker, creating it on first use."""
+    template = getattr(_worker, "template", None)
+    if template is None:
+        template = _worker.template = PlotTemplate()
+    return template.render(series, ylim, labels)
+
+
+class RenderPoolFullError(RuntimeError):
+    """Raised when a job is submitted while the queue of the render pool is full."""
+
+
+class RenderTimeoutError(TimeoutError):
+    """Raised when a render job did not finish in time."""
+
+
+class RenderPool:
+    """
+    Fixed set of render workers, each reusing its own PlotTemplate.
+
+    Args:
+        workers (int): Number of workers, i.e. of concurrent renders.
+        mode (str): "thread" for worker threads, "process" for worker processes.
+        timeout (float): Seconds after which a caller stops waiting for its job.
+        max_pending (int): Maximum number of submitted jobs not yet finished.
+    """
+
+    def __init__(
+        self,
+        workers: int = RENDER_WORKERS,
+        mode: str = RENDER_MODE,
+        timeout: float = RENDER_TIMEOUT,
+        max_pending: int = RENDER_QUEUE_SIZE,
+    ):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown render mode '{mode}', use 'thread' or 'process'")
+        self.workers = workers
+        self.mode = mode
+        self.timeout = timeout
+        self.max_pending = max(max_pending, workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def render(
+        self,
+        series: list[tuple[np.ndarray, np.ndarray]],
+        ylim: tuple[float, float] = None,
+        labels: list[str] = None,
+    ) -> bytes:
+        return self.run(render_series, series, ylim, labels)
+
+    def run(self, function: Callable, *args):
+        """
+        Runs a job on a worker and waits for its result.
+        In process mode, the function and its arguments must be picklable.
+
+        Raises:
+            RenderPoolFullError: If too many jobs are already pending.
+            RenderTimeoutError: If the job did not finish within the timeout.
+        """
+        future = self.submit(function, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # A running job cannot be interrupted, it keeps its slot until it finishes
+            future.cancel()
+            raise RenderTimeoutError(f"Rendering did not finish within {self.timeout:g}s")
+
+    def submit(self, function: Callable, *args) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise RenderPoolFullError("Too many renders in progress, please retry later")
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _get_executor(self):
+        # Created on first use, so that importing this module does not start workers
+        with self._executor_lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    # Forking a threaded server is unsafe, workers start from a fresh interpreter
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="plot-render"
+                    )
+            return self._executor
+
+
+render_pool = RenderPool()
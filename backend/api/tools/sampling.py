@@ -0,0 +1,214 @@
+# /usr/bin/python3
+from typing import Callable
+
+import numpy as np
+
+"""
+Adaptive sampling of functions for plotting.
+
+Instead of a fixed grid of 1,000 points, functions are sampled on a coarse
+uniform grid that is then refined, one vectorized pass at a time, only where
+the curve bends more than a fraction of a pixel, jumps, or enters a NaN/inf
+region. Smooth functions end up with a few hundred points at most, while
+asymptotes and domain boundaries get dense sampling.
+
+After refinement, poles (tan(x), 1/x) are detected as sign changes from far
+outside the view, and jump discontinuities (piecewise definitions) as isolated
+large jumps. The line is broken there with a NaN instead of drawing a
+vertical line, and the view is clipped to the typical range of the function.
+"""
+
+INITIAL_POINTS = 129
+MAX_POINTS = 2000  # Point budget of a single plot
+BREAK_RESERVE = 0.05  # Share of the budget kept for the NaN points breaking the lines
+MAX_PASSES = 12
+CURVATURE_TOLERANCE = 1e-3  # Allowed deviation from a straight line, relative to the y range
+MIN_INTERVAL = 1e-7  # Smallest interval refined, relative to the x range
+BREAK_JUMP = 0.05  # Jumps larger than this fraction of the y range may be discontinuities
+BREAK_RATIO = 3.0  # ... if they are that much larger than the neighbouring jumps
+OUTLIER_RATIO = 10.0  # Clip the view when values exceed the typical range that much
+
+
+def sample_function(
+    function: Callable[[np.ndarray], np.ndarray],
+    x_min: float,
+    x_max: float,
+    max_points: int = MAX_POINTS,
+) -> tuple[np.ndarray, np.ndarray, tuple[float, float] | None]:
+    """
+    Samples a vectorized function adaptively over [x_min, x_max].
+
+    Returns:
+        tuple: The x and y arrays, with NaN where the line should be broken, and
+        the y limits of the view if outliers (e.g. near poles) should be clipped, else None.
+    """
+    series, ylims = sample_functions([function], x_min, x_max, max_points)
+    return series[0][0], series[0][1], ylims[0]
+
+
+def sample_functions(
+    functions: list[Callable[[np.ndarray], np.ndarray]],
+    x_min: float,
+    x_max: float,
+    max_points: int = MAX_POINTS,
+) -> tuple[list[tuple[np.ndarray, np.ndarray]], list[tuple[float, float] | None]]:
+    """
+    Samples several vectorized functions over a shared adaptive grid of [x_min, x_max].
+    The grid is refined wherever any of the functions needs it, and every pass
+    evaluates all the functions on the new points at once.
+
+    Returns:
+        tuple: The (x, y) arrays of each function, with NaN where its line should be
+        broken, and for each function the y limits of its view if outliers should
+        be clipped, else None.
+    """
+    # The NaN points inserted at discontinuities count in the budget too
+    refine_points = max_points - int(BREAK_RESERVE * max_points)
+    x = np.linspace(x_min, x_max, min(INITIAL_POINTS, refine_points))
+    y = _evaluate(functions, x)
+    views = [_view_range(row) for row in y]
+    tolerances = [CURVATURE_TOLERANCE * (view[1] - view[0]) for view in views]
+    min_width = MIN_INTERVAL * (x_max - x_min)
+
+    for _ in range(MAX_PASSES):
+        budget = refine_points - len(x)
+        if budget <= 0:
+            break
+        scores = np.max(
+            [
+                _refinement_scores(x, row, view, tolerance, min_width)
+                for row, view, tolerance in zip(y, views, tolerances)
+            ],
+            axis=0,
+        )
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0:
+            break
+        if len(candidates) > budget:
+            # Refine where the curves are the most wrong first
+            candidates = candidates[np.argsort(scores[candidates])[-budget:]]
+            candidates.sort()
+
+        new_x = (x[candidates] + x[candidates + 1]) / 2
+        new_y = _evaluate(functions, new_x)
+        x = np.insert(x, candidates + 1, new_x)
+        y = np.insert(y, candidates + 1, new_y, axis=1)
+
+    series = [_break_discontinuities(x, row, view, max_points - len(x)) for row, view in zip(y, views)]
+    return series, [_clipped_view(row, view) for (_, row), view in zip(series, views)]
+
+
+def _evaluate(functions: list[Callable[[np.ndarray], np.ndarray]], x: np.ndarray) -> np.ndarray:
+    return np.vstack([_finite_or_nan(function(x)) for function in functions])
+
+
+def _finite_or_nan(y: np.ndarray) -> np.ndarray:
+    y = np.asarray(y, dtype=float)
+    return np.where(np.isfinite(y), y, np.nan)
+
+
+def _view_range(y: np.ndarray) -> tuple[float, float]:
+    """Typical y range of the uniformly sampled values, ignoring outliers."""
+    finite = y[np.isfinite(y)]
+    if len(finite) == 0:
+        return (-1.0, 1.0)
+    low, high = np.percentile(finite, [5, 95])
+    if high - low <= 0:
+        low, high = finite.min(), finite.max()
+    if high - low <= 0:
+        return (low - 1.0, high + 1.0)
+    return (float(low), float(high))
+
+
+def _refinement_scores(
+    x: np.ndarray,
+    y: np.ndarray,
+    view: tuple[float, float],
+    tolerance: float,
+    min_width: float,
+) -> np.ndarray:
+    """Scores each interval [x[i], x[i + 1]], intervals with a positive score get refined."""
+    scores = np.zeros(len(x) - 1)
+    finite = np.isfinite(y)
+
+    # Deviation of each interior point from the chord of its neighbours
+    t = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+    deviation = np.abs(y[1:-1] - (y[:-2] + t * (y[2:] - y[:-2])))
+    deviation = np.where(np.isfinite(deviation), deviation, 0.0)
+    deviation = np.where(deviation > tolerance, deviation, 0.0)
+    scores[:-1] = np.maximum(scores[:-1], deviation)
+    scores[1:] = np.maximum(scores[1:], deviation)
+
+    # Large jumps, which are either steep parts or discontinuities
+    jump = np.abs(np.diff(y))
+    jump = np.where(np.isfinite(jump), jump, 0.0)
+    scores = np.maximum(scores, np.where(jump > 100 * tolerance, jump, 0.0))
+
+    # Boundaries of NaN/inf regions
+    scores[finite[:-1] != finite[1:]] = np.inf
+
+    # Intervals far outside of the view on one side (e.g. along a pole) are not worth refining
+    span = view[1] - view[0]
+    above = y > view[1] + span
+    below = y < view[0] - span
+    scores[(above[:-1] & above[1:]) | (below[:-1] & below[1:])] = 0.0
+
+    scores[np.diff(x) <= min_width] = 0.0
+    return scores
+
+
+def _break_discontinuities(
+    x: np.ndarray, y: np.ndarray, view: tuple[float, float], max_breaks: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Inserts at most max_breaks NaN points in the middle of poles and isolated large jumps."""
+    span = view[1] - view[0]
+    jump = np.abs(np.diff(y))
+    jump = np.where(np.isfinite(jump), jump, 0.0)
+    neighbours = np.maximum(
+        np.concatenate(([0.0], jump[:-1])), np.concatenate((jump[1:], [0.0]))
+    )
+    jumps = (jump > BREAK_JUMP * span) & (jump > BREAK_RATIO * neighbours)
+
+    # Poles go from far above the view to far below it, or the reverse
+    above = y > view[1] + span
+    below = y < view[0] - span
+    poles = (above[:-1] & below[1:]) | (below[:-1] & above[1:])
+
+    breaks = np.flatnonzero(jumps | poles)
+    if len(breaks) > max_breaks:
+        # Over the budget, poles first, then the largest jumps
+        priority = np.where(poles[breaks], np.inf, jump[breaks])
+        breaks = np.sort(breaks[np.argsort(priority)[len(breaks) - max(max_breaks, 0) :]])
+    if len(breaks) == 0:
+        return x, y
+    x = np.insert(x, breaks + 1, (x[breaks] + x[breaks + 1]) / 2)
+    y = np.insert(y, breaks + 1, np.nan)
+    return x, y
+
+
+def _clipped_view(y: np.ndarray, view: tuple[float, float]) -> tuple[float, float] | None:
+    finite = y[np.isfinite(y)]
+    if len(finite) == 0:
+        return None
+    low, high = view
+    if finite.max() - finite.min() <= OUTLIER_RATIO * (high - low):
+        return None
+    margin = 0.25 * (high - low)
+    return (low - margin, high + margin)
+
+
+def overlay_view(
+    series: list[tuple[np.ndarray, np.ndarray]], ylims: list[tuple[float, float] | None]
+) -> tuple[float, float] | None:
+    """Returns the y limits showing all the functions of an overlay, or None if none is clipped."""
+    if all(ylim is None for ylim in ylims):
+        return None
+    low, high = np.inf, -np.inf
+    for (_, y), ylim in zip(series, ylims):
+        if ylim is None:
+            finite = y[np.isfinite(y)]
+            if len(finite) == 0:
+                continue
+            ylim = (finite.min(), finite.max())
+        low, high = min(low, ylim[0]), max(high, ylim[1])
+    return (float(low), float(high))
@@ -0,0 +1,191 @@
+# /usr/bin/python3
+import atexit
+import logging
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from os import getenv, makedirs, path, remove, scandir
+
+"""
+Logging of the agent runs.
+
+Records of the "agent" logger are put on an in-memory queue by the request
+threads and written by a single background thread, so requests never wait for
+the disk. Records tagged with a session ID (see log_session) go to the log
+file of that session, the others to the shared agent.log. Files rotate by
+size, and only a bounded number of session files are kept open at once. The
+files of a session are deleted when the session is removed (see
+remove_session_log), and those left over by a previous run once they are older
+than LOG_SESSION_MAX_AGE.
+"""
+
+LOG_DIR = getenv("LOG_DIR", "logs")
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(getenv("LOG_MAX_BYTES", 1024 * 1024))  # Size of a file before it rotates
+LOG_BACKUPS = 3  # Rotated files kept per log
+LOG_MAX_OPEN_FILES = 64  # Session log files kept open at once
+LOG_SESSION_MAX_AGE = float(getenv("LOG_SESSION_MAX_AGE", 7 * 24 * 60 * 60))  # Seconds before a session file is deleted at startup
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Session ID of the run in progress in the current thread
+_current = threading.local()
+
+
+class SessionFilter(logging.Filter):
+    """Tags records with the session ID of the current thread, if they have none."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "session_id", None) is None:
+            record.session_id = getattr(_current, "session_id", None)
+        return True
+
+
+class SessionFileHandler(logging.Handler):
+    """
+    Writes each record to the rotating log file of its session.
+
+    Args:
+        log_dir (str): Directory of the logs, session logs go to its sessions/ subdirectory.
+        max_bytes (int): Size of a file before it rotates.
+        backups (int): Rotated files kept per log.
+        max_open (int): Session files kept open at once, least recently used ones are closed.
+        max_age (float): Seconds after which the session files of previous runs are deleted.
+    """
+
+    def __init__(
+        self,
+        log_dir: str = LOG_DIR,
+        max_bytes: int = LOG_MAX_BYTES,
+        backups: int = LOG_BACKUPS,
+        max_open: int = LOG_MAX_OPEN_FILES,
+        max_age: float = LOG_SESSION_MAX_AGE,
+    ):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_open = max_open
+        self._handlers: OrderedDict[str | None, RotatingFileHandler] = OrderedDict()
+        makedirs(path.join(log_dir, "sessions"), exist_ok=True)
+        self._prune(max_age)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if getattr(record, "session_end", False):
+                self._remove(record.session_id)
+            else:
+                self._handler(getattr(record, "session_id", None)).emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def _filename(self, session_id: str | None) -> str:
+        if session_id is None:
+            return path.join(self.log_dir, "agent.log")
+        # Session IDs come from requests, keep them from escaping the directory
+        return path.join(self.log_dir, "sessions", re.sub(r"[^\w-]", "_", session_id) + ".log")
+
+    def _handler(self, session_id: str | None) -> RotatingFileHandler:
+        handler = self._handlers.get(session_id)
+        if handler is not None:
+            self._handlers.move_to_end(session_id)
+            return handler
+
+        handler = RotatingFileHandler(
+            self._filename(session_id),
+            maxBytes=self.max_bytes,
+            backupCount=self.backups,
+            encoding="utf-8",
+            delay=True,
+        )
+        handler.setFormatter(self.formatter)
+        self._handlers[session_id] = handler
+        while len(self._handlers) > self.max_open:
+            _, oldest = self._handlers.popitem(last=False)
+            oldest.close()
+        return handler
+
+    def _remove(self, session_id: str):
+        """Closes the session's file and deletes it with its rotated files."""
+        handler = self._handlers.pop(session_id, None)
+        if handler is not None:
+            handler.close()
+        filename = self._filename(session_id)
+        for name in [filename] + [f"{filename}.{index}" for index in range(1, self.backups + 1)]:
+            try:
+                remove(name)
+            except FileNotFoundError:
+                pass
+
+    def _prune(self, max_age: float):
+        """Deletes the session files not written for max_age seconds, left over by previous runs."""
+        sessions_dir = path.join(self.log_dir, "sessions")
+        oldest = time.time() - max_age
+        for entry in scandir(sessions_dir):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < oldest:
+                    remove(entry.path)
+            except OSError:
+                pass
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+@contextmanager
+def log_session(session_id: str | None):
+    """Tags the records logged by the current thread within the block with the session ID."""
+    previous = getattr(_current, "session_id", None)
+    _current.session_id = session_id
+    try:
+        yield
+    finally:
+        _current.session_id = previous
+
+
+def remove_session_log(session_id: str):
+    """
+    Deletes the log files of a removed session.
+
+    Goes through the queue like the records, so the records of the session
+    still queued are written before its files are deleted.
+    """
+    record = logging.LogRecord(logger.name, logging.INFO, __file__, 0, "End of session", None, None)
+    record.session_id = session_id
+    record.session_end = True
+    for handler in logger.handlers:
+        handler.handle(record)
+
+
+def setup_logger() -> logging.Logger:
+    """Attaches the queue and its writer thread to the "agent" logger."""
+    logger = logging.getLogger("agent")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(SessionFilter())
+    logger.addHandler(queue_handler)
+
+    file_handler = SessionFileHandler()
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, file_handler)
+    listener.start()
+
+    def stop():
+        # Writes the queued records before the interpreter exits
+        listener.stop()
+        file_handler.close()
+
+    atexit.register(stop)
+    return logger
+
+
+logger = setup_logger()
@@ -0,0 +1,256 @@
+# /usr/bin/python3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import getenv
+from typing import Callable
+
+from .agent import Agent, init_agent
+from .cancellation import CancellationToken, CancelledRun, cancellable
+from .document import DocumentContext
+from .session_logs import log_session, logger, remove_session_log
+
+"""
+Per-learner session state.
+
+Every learner gets its own Session, created by /api/init, holding their Agent
+state (fixed context, questioning flag) and the text blocks of their document.
+Sessions live in a bounded SessionStore: least recently used sessions are
+evicted once the store is over its session count or memory budget, and idle
+sessions expire after a TTL. The log files of a session are deleted with it.
+
+Submissions of a session are coalesced: a submission waits a short window and
+for the run in progress in the session, if any, and every submission arriving
+meanwhile joins it. Their blocks are all stored before a single agent run over
+the latest document, whose result is returned to all of them. A submission
+also cancels the run in progress in the session: its submissions then get the
+result of the newer run.
+"""
+
+SESSION_TTL = 60 * 60  # Seconds of inactivity before a session expires
+MAX_SESSIONS = 1000
+MAX_SESSIONS_BYTES = 256 * 1024 * 1024  # Approximate memory budget for all sessions
+COALESCE_WINDOW = float(getenv("BODY_COALESCE_WINDOW", 0.3))  # Seconds a submission waits for others
+
+
+class _Batch:
+    """Submissions of a session answered by a single agent run."""
+
+    def __init__(self):
+        self.blocks: dict = dict()  # Latest (text, balise) of each submitted block
+        self.size = 0
+        self.future = Future()
+
+
+class Session:
+    """State of a single learner: their agent and their document."""
+
+    def __init__(self, session_id: str, agent: Agent):
+        self.id = session_id
+        self.agent = agent
+        self.document = DocumentContext()
+        self.lock = threading.Lock()  # Serializes agent runs within the session
+        self.batch: _Batch = None  # Submissions waiting for the next agent run
+        self.token: CancellationToken = None  # Token of the latest agent run
+        self._batch_lock = threading.Lock()
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.nbytes = self._base_nbytes()
+
+    def _base_nbytes(self) -> int:
+        size = sys.getsizeof(self) + self.document.nbytes
+        for message in self.agent.fixed_context or []:
+            size += sys.getsizeof(message["content"])
+        return size
+
+    def set_block(self, block_id, text: str, balise: str) -> int:
+        """
+        Stores a text block of the document.
+
+        Returns:
+            int: The change in the session's approximate memory footprint.
+        """
+        delta = self.document.set_block(block_id, text, balise)
+        self.nbytes += delta
+        return delta
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of sessions, with LRU and TTL eviction.
+
+    Args:
+        max_sessions (int): Maximum number of live sessions.
+        max_bytes (int): Approximate memory budget shared by all sessions.
+        ttl (float): Seconds of inactivity after which a session expires.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = MAX_SESSIONS,
+        max_bytes: int = MAX_SESSIONS_BYTES,
+        ttl: float = SESSION_TTL,
+        coalesce_window: float = COALESCE_WINDOW,
+    ):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.coalesce_window = coalesce_window
+        self.nbytes = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def create(self, fixed_questions: list[dict]) -> Session:
+        """Creates a session with an agent initialized with the fixed questions."""
+        session_id = uuid.uuid4().hex
+        session = Session(session_id, init_agent(fixed_questions, session_id))
+        with self._lock:
+            self._sessions[session.id] = session
+            self.nbytes += session.nbytes
+            self._evict()
+        return session
+
+    def get(self, session_id: str) -> Session | None:
+        """Returns the session and marks it as recently used, or None if unknown or expired."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            now = time.time()
+            if now - session.last_access > self.ttl:
+                self._remove(session_id)
+                return None
+            session.last_access = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def set_block(self, session: Session, block_id, text: str, balise: str):
+        """Stores a text block in the session, keeping memory accounting up to date."""
+        with self._lock:
+            delta = session.set_block(block_id, text, balise)
+            if session.id in self._sessions:
+                self.nbytes += delta
+                self._evict(keep=session.id)
+
+    def submit(
+        self, session: Session, block_id, text: str, balise: str, run: Callable[[], dict]
+    ) -> tuple[dict, bool]:
+        """
+        Submits a text block and returns the answer of the agent run covering it.
+
+        Args:
+            session (Session): The session of the submission.
+            block_id: The ID of the submitted block.
+            text (str): The text of the block.
+            balise (str): The balise of the block.
+            run (Callable): Runs the agent over the session's document, e.g. a call to run_agent.
+
+        Returns:
+            tuple[dict, bool]: The answer, and whether it is shared with an earlier submission
+            of the same run, which got it too.
+        """
+        with session._batch_lock:
+            batch = session.batch
+            leader = batch is None
+            if leader:
+                batch = session.batch = _Batch()
+            batch.blocks[block_id] = (text, balise)
+            batch.size += 1
+            # The run in progress, if any, is answering an outdated document
+            if session.token is not None:
+                session.token.cancel()
+        if not leader:
+            with self._lock:
+                self.coalesced += 1
+            return batch.future.result(), True
+
+        time.sleep(self.coalesce_window)
+        with session.lock:
+            # Submissions arriving from now on go to the next run
+            with session._batch_lock:
+                session.batch = None
+                token = session.token = CancellationToken()
+            try:
+                for block_id, (text, balise) in batch.blocks.items():
+                    self.set_block(session, block_id, text, balise)
+                if batch.size > 1:
+                    with log_session(session.id):
+                        logger.info("Coalesced %d submissions into a single run.", batch.size)
+                with cancellable(token):
+                    result = run()
+            except CancelledRun as e:
+                with session._batch_lock:
+                    successor = session.batch
+                if successor is None:
+                    batch.future.set_exception(e)
+                    raise
+            except BaseException as e:
+                batch.future.set_exception(e)
+                raise
+            else:
+                batch.future.set_result(result)
+                return result, False
+
+        # Superseded by a newer submission, whose run answers this one too
+        with log_session(session.id):
+            logger.info("Run superseded by a newer submission, cancelled.")
+        try:
+            result = successor.future.result()
+        except BaseException as e:
+            batch.future.set_exception(e)
+            raise
+        batch.future.set_result(result)
+        return result, True
+
+    def remove(self, session_id: str):
+        with self._lock:
+            self._remove(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self.nbytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+            }
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.nbytes -= session.nbytes
+            remove_session_log(session_id)
+
+    def _evict(self, keep: str = None):
+        # Sessions are kept in access order, so expired ones are at the front
+        now = time.time()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session_id == keep or now - session.last_access <= self.ttl:
+                break
+            self._remove(session_id)
+            self.evictions += 1
+
+        # Then drop least recently used sessions until under budget
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or self.nbytes > self.max_bytes
+        ):
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                self._sessions.move_to_end(session_id)
+                session_id = next(iter(self._sessions))
+            self._remove(session_id)
+            self.evictions += 1
+
+
+sessions = SessionStore()
@@ -6,51 +6,752 @@ Gère les mises à jour de progression en temps réel via WebSocket
 from flask import Flask, request
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from os import getenv
+import atexit
+import socket
+import sqlite3
+import threading
 import time
 import random
 import json
 
+# Stockage partagé de la progression (ex. redis://localhost:6379/0), en mémoire si absent
+PROGRESS_STORE_URL = getenv("PROGRESS_STORE_URL")
+# File de messages partagée par les processus serveurs (ex. redis://localhost:6379/0),
+# pour qu'un événement émis par l'un atteigne les clients connectés aux autres
+SOCKETIO_MESSAGE_QUEUE = getenv("SOCKETIO_MESSAGE_QUEUE")
+PROGRESS_SERVER_PORT = int(getenv("PROGRESS_SERVER_PORT", 8001))
+# Identifiant stable du processus serveur dans le stockage partagé : au redémarrage, le
+# processus efface les progressions laissées par les connexions de sa vie précédente
+PROGRESS_SERVER_ID = getenv("PROGRESS_SERVER_ID") or f"{socket.gethostname()}:{PROGRESS_SERVER_PORT}"
+# Base SQLite où la progression des apprenants est sauvegardée, désactivée si vide
+PROGRESS_DB_PATH = getenv("PROGRESS_DB_PATH", "progress.db")
+PROGRESS_FLUSH_INTERVAL = float(getenv("PROGRESS_FLUSH_INTERVAL", 1.0))  # Secondes entre deux écritures
+# Modèle LiteLLM qui corrige les réponses (ex. claude-3-5-haiku-latest), évaluation simulée si absent
+GRADING_MODEL = getenv("GRADING_MODEL")
+GRADING_MAX_BATCH = int(getenv("GRADING_MAX_BATCH", 32))  # Réponses corrigées par un même appel
+GRADING_MAX_LATENCY = float(getenv("GRADING_MAX_LATENCY", 0.05))  # Secondes d'attente d'autres réponses
+
 app = Flask(__name__)
 # app.config['SECRET_KEY'] = 'duolingo_progress_secret'
 
 # Configuration CORS pour permettre les connexions depuis le frontend
 CORS(app, origins="http://localhost:3000")
-socketio = SocketIO(app, cors_allowed_origins="http://localhost:3000")
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="http://localhost:3000",
+    message_queue=SOCKETIO_MESSAGE_QUEUE
+)
+
+CHECKPOINTS = (25, 50, 75, 100)
+
+# Agrégats tenus à jour sur toutes les progressions
+AGGREGATES = ('users', 'total_progress', 'total_answers', 'total_correct', 'users_at_100')
+
+
+class ProgressRecord:
+    """Progression d'un client, compacte grâce aux __slots__"""
+
+    __slots__ = (
+        'progress',
+        'checkpoints',  # Masque de bits des checkpoints atteints, dans l'ordre de CHECKPOINTS
+        'start_time',
+        'total_answers',
+        'correct_answers',
+        'streak',
+        'difficulty',
+    )
+
+    # Type de chaque champ, pour relire une progression sérialisée
+    TYPES = {
+        'progress': int,
+        'checkpoints': int,
+        'start_time': float,
+        'total_answers': int,
+        'correct_answers': int,
+        'streak': int,
+        'difficulty': float,
+    }
+
+    def __init__(self):
+        self.progress = 0
+        self.checkpoints = 0
+        self.start_time = time.time()
+        self.total_answers = 0
+        self.correct_answers = 0
+        self.streak = 0
+        self.difficulty = 1.0
+
+    @property
+    def accuracy(self):
+        return (self.correct_answers / max(self.total_answers, 1)) * 100
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Relit une progression sérialisée, dont les valeurs peuvent être des chaînes"""
+        record = cls()
+        for name, kind in cls.TYPES.items():
+            if name in data:
+                setattr(record, name, kind(data[name]))
+        return record
+
+    def contribution(self, sign=1):
+        """Part de cette progression dans les agrégats, retirée si sign vaut -1"""
+        return {
+            'users': sign,
+            'total_progress': sign * self.progress,
+            'total_answers': sign * self.total_answers,
+            'total_correct': sign * self.correct_answers,
+            'users_at_100': sign * (self.progress >= 100),
+        }
+
+    def apply_answer(self, evaluation):
+        """
+        Applique l'évaluation d'une réponse à la progression
+
+        Args:
+            evaluation (dict): Résultat de ProgressManager.score
+
+        Returns:
+            tuple: La liste des nouveaux checkpoints atteints et la variation des agrégats
+        """
+        before = self.contribution(-1)
+        self.total_answers += 1
+        self.streak = evaluation['streak']
+        new_checkpoints = []
+        if evaluation['success']:
+            self.correct_answers += 1
+            self.progress = min(self.progress + evaluation['progress_increment'], 100)
+
+            # Vérifier les nouveaux checkpoints atteints
+            for index, checkpoint in enumerate(CHECKPOINTS):
+                if self.progress >= checkpoint and not self.checkpoints & (1 << index):
+                    self.checkpoints |= 1 << index
+                    new_checkpoints.append(checkpoint)
+        deltas = {name: value + before[name] for name, value in self.contribution().items()}
+        return new_checkpoints, deltas
+
+
+def stats_from_totals(totals):
+    """Statistiques globales à partir des agrégats"""
+    total_users = totals['users']
+    if total_users == 0:
+        return {
+            'total_users': 0,
+            'average_progress': 0,
+            'total_answers': 0,
+            'global_accuracy': 0
+        }
+    return {
+        'total_users': total_users,
+        'average_progress': totals['total_progress'] / total_users,
+        'total_answers': totals['total_answers'],
+        'global_accuracy': (totals['total_correct'] / max(totals['total_answers'], 1)) * 100,
+        'users_at_100_percent': totals['users_at_100']
+    }
+
+
+class ProgressStore(ABC):
+    """
+    Progression des clients connectés, indexée par sid
+
+    Les agrégats de toutes les progressions sont tenus à jour à chaque événement,
+    les statistiques globales ne parcourent donc jamais les clients.
+    """
+
+    @abstractmethod
+    def __len__(self):
+        """Nombre de clients connectés"""
+
+    @abstractmethod
+    def get(self, sid):
+        """Retourne la progression du client, None s'il n'est pas connecté"""
+
+    @abstractmethod
+    def get_or_create(self, sid):
+        """Retourne la progression du client, créée si elle n'existe pas"""
+
+    @abstractmethod
+    def remove(self, sid):
+        """Supprime la progression du client et la retourne, None si elle n'existe pas"""
+
+    @abstractmethod
+    def put(self, sid, record):
+        """Remplace la progression du client, par exemple par celle restaurée du disque"""
+
+    def reset(self, sid):
+        """Remet à zéro la progression du client, sans toucher à celle des autres"""
+        return self.put(sid, ProgressRecord())
+
+    @abstractmethod
+    def record_answer(self, sid, is_correct, score):
+        """
+        Évalue une réponse corrigée à partir de la progression actuelle du client et l'y applique,
+        de façon atomique : deux réponses rapprochées font bien progresser le streak
+
+        Args:
+            sid (str): Identifiant de session du client
+            is_correct (bool): Correction de la réponse
+            score (Callable): Calcule l'évaluation d'une réponse, voir ProgressManager.score
+
+        Returns:
+            tuple: La progression mise à jour, l'évaluation et la liste des nouveaux checkpoints
+                atteints, ou None si le client s'est déconnecté entre-temps : la progression
+                n'est pas recréée
+        """
+
+    @abstractmethod
+    def stats(self):
+        """Statistiques globales, en temps constant"""
+
+    def release(self):
+        """
+        Supprime les progressions des clients de ce processus serveur, retirées des agrégats
+
+        Appelé au démarrage, pour les connexions mortes avec le processus précédent, et à
+        l'arrêt. Rien à faire pour un stockage qui ne survit pas au processus.
+        """
+
+
+class MemoryProgressStore(ProgressStore):
+    """Progression gardée dans la mémoire du processus, pour un serveur unique"""
+
+    def __init__(self):
+        self._records = {}
+        self._totals = dict.fromkeys(AGGREGATES, 0)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def _add(self, deltas):
+        for name, value in deltas.items():
+            self._totals[name] += value
+
+    def get(self, sid):
+        with self._lock:
+            return self._records.get(sid)
+
+    def get_or_create(self, sid):
+        with self._lock:
+            record = self._records.get(sid)
+            if record is None:
+                record = self._records[sid] = ProgressRecord()
+                self._add(record.contribution())
+            return record
+
+    def remove(self, sid):
+        with self._lock:
+            record = self._records.pop(sid, None)
+            if record is not None:
+                self._add(record.contribution(-1))
+            return record
+
+    def put(self, sid, record):
+        with self._lock:
+            previous = self._records.get(sid)
+            if previous is not None:
+                self._add(previous.contribution(-1))
+            self._records[sid] = record
+            self._add(record.contribution())
+            return record
+
+    def record_answer(self, sid, is_correct, score):
+        with self._lock:
+            record = self._records.get(sid)
+            if record is None:
+                return None
+            evaluation = score(record, is_correct)
+            new_checkpoints, deltas = record.apply_answer(evaluation)
+            self._add(deltas)
+            return record, evaluation, new_checkpoints
+
+    def stats(self):
+        with self._lock:
+            return stats_from_totals(self._totals)
+
+
+class RedisProgressStore(ProgressStore):
+    """
+    Progression gardée dans Redis, partagée par plusieurs processus serveurs
+
+    Chaque progression est un hash, et les agrégats un hash mis à jour dans la même
+    transaction (WATCH/MULTI) que la progression modifiée. N'importe quel serveur
+    compatible avec le protocole Redis convient, par exemple un redis-server local.
+
+    Les progressions sont indexées par sid, qui ne survit pas à sa connexion : chaque
+    processus serveur tient dans la même transaction l'ensemble des sids de ses clients,
+    que release retire du stockage et des agrégats. Un processus qui plante laisse ses
+    progressions derrière lui jusqu'à son redémarrage sous le même server_id.
+
+    Args:
+        client: Client redis-py
+        prefix (str): Préfixe des clés, pour partager une base avec d'autres données
+        server_id (str): Identifiant stable du processus serveur, voir PROGRESS_SERVER_ID
+    """
+
+    def __init__(self, client, prefix='progress:', server_id=PROGRESS_SERVER_ID):
+        self.client = client
+        self.prefix = prefix
+        self.totals_key = prefix + 'totals'
+        self.sids_key = prefix + 'server:' + server_id + ':sids'
+
+    @classmethod
+    def from_url(cls, url, server_id=PROGRESS_SERVER_ID):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True), server_id=server_id)
+
+    def _key(self, sid):
+        return self.prefix + 'user:' + sid
+
+    def _read(self, pipe, key):
+        data = pipe.hgetall(key)
+        return ProgressRecord.from_dict(data) if data else None
+
+    def _update(self, sid, change):
+        """
+        Applique change(record) -> (record, deltas, result) à la progression du client dans
+        une transaction, rejouée si la progression a changé entre-temps. Retourne result.
+        """
+        key = self._key(sid)
+        outcome = []
+
+        def transaction(pipe):
+            record, deltas, result = change(self._read(pipe, key))
+            pipe.multi()
+            pipe.delete(key)
+            if record is not None:
+                pipe.hset(key, mapping=record.to_dict())
+                pipe.sadd(self.sids_key, sid)
+            else:
+                pipe.srem(self.sids_key, sid)
+            for name, value in deltas.items():
+                if value:
+                    pipe.hincrby(self.totals_key, name, int(value))
+            outcome[:] = [result]
+
+        self.client.transaction(transaction, key)
+        return outcome[0]
+
+    def __len__(self):
+        return int(self.client.hget(self.totals_key, 'users') or 0)
+
+    def get(self, sid):
+        return self._read(self.client, self._key(sid))
+
+    def get_or_create(self, sid):
+        record = self.get(sid)
+        if record is not None:
+            return record
+
+        def create(record):
+            if record is not None:
+                return record, {}, record
+            record = ProgressRecord()
+            return record, record.contribution(), record
+
+        return self._update(sid, create)
+
+    def remove(self, sid):
+        def remove(record):
+            return None, record.contribution(-1) if record is not None else {}, record
+
+        return self._update(sid, remove)
+
+    def put(self, sid, record):
+        def put(previous):
+            deltas = record.contribution()
+            if previous is not None:
+                for name, value in previous.contribution(-1).items():
+                    deltas[name] += value
+            return record, deltas, record
+
+        return self._update(sid, put)
+
+    def record_answer(self, sid, is_correct, score):
+        def answer(record):
+            if record is None:
+                return None, {}, None
+            # Rejoué avec la progression relue si elle a changé entre-temps
+            evaluation = score(record, is_correct)
+            new_checkpoints, deltas = record.apply_answer(evaluation)
+            return record, deltas, (record, evaluation, new_checkpoints)
+
+        return self._update(sid, answer)
+
+    def stats(self):
+        totals = self.client.hgetall(self.totals_key)
+        return stats_from_totals({name: int(totals.get(name, 0)) for name in AGGREGATES})
+
+    def release(self):
+        for sid in self.client.smembers(self.sids_key):
+            self.remove(sid)
+
+
+def create_progress_store(url=None):
+    """Crée le stockage de la progression : Redis si une URL est donnée, sinon en mémoire"""
+    if url:
+        return RedisProgressStore.from_url(url)
+    return MemoryProgressStore()
+
+
+# Stockage de la progression des utilisateurs, partagé entre les processus si PROGRESS_STORE_URL est défini
+user_progress = create_progress_store(PROGRESS_STORE_URL)
+# Les connexions de la vie précédente de ce processus sont mortes avec lui
+user_progress.release()
+atexit.register(user_progress.release)
+
+
+class ProgressPersistence:
+    """
+    Sauvegarde différée (write-behind) de la progression des apprenants dans SQLite
+
+    Les événements ne font que déposer la dernière progression de l'apprenant dans une
+    file en mémoire, sans attendre le disque. Un thread d'arrière-plan vide la file à
+    intervalle régulier et écrit toutes les progressions en attente dans une seule
+    transaction. Les progressions écrites depuis moins d'un intervalle peuvent être
+    perdues en cas d'arrêt brutal ; la file est vidée à l'arrêt normal du processus.
+
+    Args:
+        db_path (str): Chemin de la base SQLite
+        interval (float): Secondes entre deux écritures
+    """
+
+    UPSERT = (
+        "INSERT OR REPLACE INTO learner_progress VALUES "
+        "(:learner_id, :progress, :checkpoints, :start_time, :total_answers, "
+        ":correct_answers, :streak, :difficulty, :updated)"
+    )
+    SELECT = (
+        "SELECT progress, checkpoints, start_time, total_answers, correct_answers, streak, "
+        "difficulty FROM learner_progress WHERE learner_id = ?"
+    )
+
+    def __init__(self, db_path, interval=PROGRESS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()  # Protège la connexion
+        self._pending = {}  # File des progressions à écrire, la dernière par apprenant
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # Les transactions restent atomiques, seul le fsync de chaque commit est évité
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS learner_progress (
+                    learner_id TEXT PRIMARY KEY,
+                    progress INTEGER NOT NULL,
+                    checkpoints INTEGER NOT NULL,
+                    start_time REAL NOT NULL,
+                    total_answers INTEGER NOT NULL,
+                    correct_answers INTEGER NOT NULL,
+                    streak INTEGER NOT NULL,
+                    difficulty REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+        self._thread = threading.Thread(target=self._run, name="progress-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, learner_id, record):
+        """Met la progression en file d'écriture, sans attendre le disque"""
+        row = record.to_dict()
+        row['learner_id'] = learner_id
+        row['updated'] = time.time()
+        with self._pending_lock:
+            self._pending[learner_id] = row
+
+    def load(self, learner_id):
+        """Retourne la dernière progression sauvegardée de l'apprenant, None s'il n'en a pas"""
+        with self._pending_lock:
+            row = self._pending.get(learner_id)
+        if row is not None:
+            return ProgressRecord.from_dict(row)
+        with self._lock:
+            values = self._connection.execute(self.SELECT, (learner_id,)).fetchone()
+        if values is None:
+            return None
+        return ProgressRecord.from_dict(dict(zip(ProgressRecord.__slots__, values)))
+
+    def flush(self):
+        """Écrit les progressions en attente dans une seule transaction"""
+        with self._pending_lock:
+            rows, self._pending = list(self._pending.values()), {}
+        if not rows:
+            return
+        try:
+            with self._lock, self._connection:
+                self._connection.executemany(self.UPSERT, rows)
+        except sqlite3.Error as e:
+            print(f'⚠️ Échec de la sauvegarde de {len(rows)} progressions: {e}')
+            # Remises en file, sauf si une progression plus récente y est déjà
+            with self._pending_lock:
+                for row in rows:
+                    self._pending.setdefault(row['learner_id'], row)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+# Sauvegarde de la progression, pour la retrouver à la reconnexion ou au redémarrage
+progress_persistence = ProgressPersistence(PROGRESS_DB_PATH) if PROGRESS_DB_PATH else None
+
+# Identifiant stable de l'apprenant des clients connectés qui en ont donné un, indexé par sid
+learner_ids = {}
+
+
+def save_progress(sid, record):
+    """Sauvegarde la progression, seulement si le client a donné un identifiant stable"""
+    learner_id = learner_ids.get(sid)
+    if progress_persistence is not None and learner_id is not None:
+        progress_persistence.save(learner_id, record)
+
+GRADING_PROMPT = """### SYSTEM PROMPT ###
+You are grading the answers of students to questions of their tutor. Each answer below is numbered, with the question it answers when known.
+
+### ANSWERS ###
+{answers}
+
+### SYSTEM PROMPT ###
+For each answer, in order, decide whether it is correct. Be lenient with the wording and strict with the substance. Return only the JSON object, with exactly one grade per answer."""
+
+GRADING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "grades",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"correct": {"type": "array", "items": {"type": "boolean"}}},
+            "required": ["correct"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+class LLMGrader:
+    """
+    Corrige un lot de réponses en un seul appel LLM
+
+    Args:
+        model_id (str): Identifiant LiteLLM du modèle
+    """
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None:
+                # Importé au premier lot seulement, l'évaluation simulée n'en a pas besoin
+                from smolagents import LiteLLMModel
+
+                self._model = LiteLLMModel(
+                    model_id=self.model_id, api_key=getenv("API_KEY"), temperature=0.0
+                )
+            return self._model
+
+    def __call__(self, answers):
+        """
+        Args:
+            answers (list): Données des réponses soumises
+
+        Returns:
+            tuple: La correction de chaque réponse (bool) et les tokens de l'appel
+        """
+        lines = []
+        for index, answer in enumerate(answers, 1):
+            if isinstance(answer, dict) and 'answer' in answer:
+                question = answer.get('question') or '(unknown)'
+                lines.append(f"{index}. Question: {question}\n   Answer: {answer['answer']}")
+            else:
+                lines.append(f"{index}. Answer: {json.dumps(answer, ensure_ascii=False)}")
+        message = self._get_model()(
+            messages=[{"role": "user", "content": GRADING_PROMPT.format(answers="\n".join(lines))}],
+            response_format=GRADING_RESPONSE_FORMAT,
+        )
+        grades = json.loads(message.content.strip().strip("`").removeprefix("json"))["correct"]
+        if len(grades) != len(answers) or not all(isinstance(grade, bool) for grade in grades):
+            raise ValueError(f"{len(grades)} notes pour {len(answers)} réponses")
+        usage = message.token_usage
+        tokens = usage.input_tokens + usage.output_tokens if usage is not None else 0
+        return grades, tokens
+
+
+def run_blocking(socketio, function, *args):
+    """
+    Exécute un appel bloquant (réseau, disque) dans un thread du système, sans bloquer
+    la boucle du mode asynchrone de Socket.IO : seule la tâche appelante attend le résultat
+
+    En mode threading, l'appelant est déjà un thread du système et l'appel est direct.
+    """
+    async_mode = socketio.server.eio.async_mode
+    if async_mode == 'eventlet':
+        from eventlet import tpool
+
+        return tpool.execute(function, *args)
+    if async_mode in ('gevent', 'gevent_uwsgi'):
+        import gevent
+
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+class GradingService:
+    """
+    Regroupe les réponses soumises par tous les clients en lots corrigés par un seul appel
+
+    Un lot part dès qu'il atteint max_batch réponses, ou max_latency secondes après sa
+    première réponse. Les lots sont corrigés en parallèle, et le coût de chaque appel
+    est partagé entre les réponses de son lot. Les tâches et la file sont celles du mode
+    asynchrone de Socket.IO (threads, eventlet, gevent). L'appel au modèle, bloquant,
+    tourne dans un vrai thread du système (voir run_blocking) : sans monkey patching,
+    il gèlerait sinon toutes les connexions en mode eventlet ou gevent le temps d'un
+    aller-retour. Les corrections sont rendues dans la tâche du lot, les callbacks des
+    Futures (send_evaluation) s'exécutent donc dans le contexte du mode asynchrone.
+
+    Args:
+        socketio (SocketIO): Serveur dont les tâches d'arrière-plan corrigent les lots
+        grade_batch (Callable): Corrige une liste de réponses, retourne les corrections et les tokens
+        max_batch (int): Réponses au plus par lot
+        max_latency (float): Secondes au plus qu'une réponse attend d'autres réponses
+    """
+
+    def __init__(self, socketio, grade_batch, max_batch=GRADING_MAX_BATCH, max_latency=GRADING_MAX_LATENCY):
+        self.socketio = socketio
+        self.grade_batch = grade_batch
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.graded = 0
+        self.tokens = 0
+
+    def submit(self, answer):
+        """Met la réponse en file, retourne le Future de sa correction et de sa part des tokens"""
+        with self._lock:
+            if self._queue is None:
+                self._queue = self.socketio.server.eio.create_queue()
+                self._empty = self.socketio.server.eio.get_queue_empty_exception()
+                self.socketio.start_background_task(self._collect)
+        future = Future()
+        self._queue.put((answer, future))
+        return future
+
+    def _collect(self):
+        """Forme les lots, indéfiniment"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except self._empty:
+                    break
+            self.socketio.start_background_task(self._grade, batch)
+
+    def _grade(self, batch):
+        try:
+            grades, tokens = run_blocking(self.socketio, self.grade_batch, [answer for answer, _ in batch])
+        except Exception as e:
+            print(f'⚠️ Échec de la correction d\'un lot de {len(batch)} réponses: {e}')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.graded += len(batch)
+            self.tokens += tokens
+        share = tokens / len(batch)
+        for (_, future), grade in zip(batch, grades):
+            future.set_result((grade, share))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'graded_answers': self.graded,
+                'average_batch_size': self.graded / max(self.batches, 1),
+                'tokens_per_answer': self.tokens / max(self.graded, 1)
+            }
 
-# Stockage en mémoire de la progression des utilisateurs
-user_progress = {}
 
 class ProgressManager:
-    """Gestionnaire de progression avec logique d'évaluation IA simulée"""
+    """
+    Gestionnaire de progression, avec évaluation des réponses par l'IA ou simulée
+
+    Il ne garde aucun état : le streak et la difficulté sont ceux de la progression
+    du client évalué.
+
+    Args:
+        grading (GradingService): Service de correction des réponses, None pour simuler l'évaluation
+    """
     
-    def __init__(self):
+    def __init__(self, grading=None):
         self.base_increment = 10  # Progression de base par bonne réponse
-        self.streak_bonus = 0
-        self.difficulty_multiplier = 1.0
+        self.grading = grading
     
     def evaluate_answer(self, answer_data):
         """
-        Simule l'évaluation d'une réponse par l'IA
+        Corrige une réponse, avec celles soumises au même moment par les autres clients
+        
+        Seule la correction passe par le lot : la progression est calculée par score quand
+        elle est enregistrée, à partir du streak du client à ce moment-là.
         
         Args:
             answer_data (dict): Données de la réponse soumise
             
         Returns:
-            dict: Résultat de l'évaluation avec progression et récompenses
+            Future: La correction de la réponse (bool) et sa part des tokens de son lot
+        """
+        if self.grading is None:
+            # Simulation de l'évaluation IA (70% de chance de bonne réponse)
+            verdict = Future()
+            verdict.set_result((random.random() > 0.3, 0))
+            return verdict
+        return self.grading.submit(answer_data)
+    
+    def score(self, record, is_correct):
         """
-        # Simulation de l'évaluation IA (70% de chance de bonne réponse)
-        is_correct = random.random() > 0.3
+        Calcule la progression et les récompenses d'une réponse corrigée
         
+        Args:
+            record (ProgressRecord): Progression du client avant la réponse
+            is_correct (bool): Correction de la réponse
+            
+        Returns:
+            dict: Résultat de l'évaluation avec progression et récompenses
+        """
         if is_correct:
             # Calcul de la progression
             progress_increment = self.base_increment
             
             # Bonus de streak (réponses consécutives correctes)
-            self.streak_bonus = min(self.streak_bonus + 2, 10)
-            progress_increment += self.streak_bonus
+            streak = min(record.streak + 2, 10)
+            progress_increment += streak
             
             # Multiplicateur de difficulté
-            progress_increment = int(progress_increment * self.difficulty_multiplier)
+            progress_increment = int(progress_increment * record.difficulty)
             
             reward_message = self._generate_reward_message(progress_increment)
             
@@ -58,12 +759,11 @@ class ProgressManager:
                 'success': True,
                 'progress_increment': progress_increment,
                 'reward': reward_message,
-                'streak': self.streak_bonus,
+                'streak': streak,
                 'message': '✅ Excellent ! Bonne réponse !'
             }
         else:
             # Réinitialiser le streak en cas d'erreur
-            self.streak_bonus = 0
             return {
                 'success': False,
                 'progress_increment': 0,
@@ -81,28 +781,40 @@ class ProgressManager:
         else:
             return "👍 Bien joué ! +" + str(increment) + "%"
 
-# Instance globale du gestionnaire de progression
-progress_manager = ProgressManager()
+# Service de correction par lots, si un modèle est configuré
+grading_service = GradingService(socketio, LLMGrader(GRADING_MODEL)) if GRADING_MODEL else None
+# Instance globale du gestionnaire de progression, sans état propre aux clients
+progress_manager = ProgressManager(grading_service)
 
 @socketio.on('connect')
-def handle_connect():
-    """Gestion de la connexion d'un client"""
+def handle_connect(auth=None):
+    """
+    Gestion de la connexion d'un client
+
+    Args:
+        auth (dict): Données d'authentification du client, dont son identifiant stable
+            'learner_id', à défaut lu dans les paramètres de l'URL. Sans identifiant stable,
+            la progression n'est ni sauvegardée ni restaurée : elle ne dure que la connexion
+    """
     print(f'🔗 Client connecté: {request.sid}')
     
-    # Initialiser la progression du client s'il n'existe pas
-    if request.sid not in user_progress:
-        user_progress[request.sid] = {
-            'progress': 0,
-            'checkpoints_reached': [],
-            'start_time': time.time(),
-            'total_answers': 0,
-            'correct_answers': 0
-        }
+    learner_id = (auth or {}).get('learner_id') or request.args.get('learner_id')
+    saved = None
+    if learner_id:
+        learner_ids[request.sid] = str(learner_id)
+        # Restaurer la progression sauvegardée de l'apprenant, sinon l'initialiser
+        if progress_persistence is not None:
+            saved = progress_persistence.load(learner_ids[request.sid])
+    if saved is not None:
+        saved.start_time = time.time()
+        record = user_progress.put(request.sid, saved)
+    else:
+        record = user_progress.get_or_create(request.sid)
     
     # Envoyer la progression actuelle au client
     emit('progress_update', {
         'type': 'progress_update',
-        'progress': user_progress[request.sid]['progress'],
+        'progress': record.progress,
         'message': 'Connexion établie - Prêt à apprendre ! 🚀'
     })
 
@@ -111,72 +823,77 @@ def handle_disconnect():
     """Gestion de la déconnexion d'un client"""
     print(f'🔌 Client déconnecté: {request.sid}')
     
-    # Optionnel: sauvegarder la progression avant suppression
-    if request.sid in user_progress:
-        session_data = user_progress[request.sid]
-        session_duration = time.time() - session_data['start_time']
-        accuracy = (session_data['correct_answers'] / max(session_data['total_answers'], 1)) * 100
+    # Supprimer les données de session, après les avoir sauvegardées
+    session_data = user_progress.remove(request.sid)
+    if session_data is not None:
+        save_progress(request.sid, session_data)
+        session_duration = time.time() - session_data.start_time
         
         print(f'📊 Session terminée:')
         print(f'   - Durée: {session_duration:.1f}s')
-        print(f'   - Progression: {session_data["progress"]}%')
-        print(f'   - Précision: {accuracy:.1f}%')
-        
-        # Supprimer les données de session
-        del user_progress[request.sid]
+        print(f'   - Progression: {session_data.progress}%')
+        print(f'   - Précision: {session_data.accuracy:.1f}%')
+    learner_ids.pop(request.sid, None)
 
 @socketio.on('answer_submission')
 def handle_answer_submission(data):
     """
-    Traite la soumission d'une réponse et met à jour la progression
+    Traite la soumission d'une réponse, la progression est envoyée une fois la réponse corrigée
     
     Args:
         data (dict): Données de la réponse soumise
     """
     print(f'📝 Réponse reçue de {request.sid}: {data}')
     
-    if request.sid not in user_progress:
-        user_progress[request.sid] = {
-            'progress': 0,
-            'checkpoints_reached': [],
-            'start_time': time.time(),
-            'total_answers': 0,
-            'correct_answers': 0
-        }
+    # Évaluer la réponse, par l'IA avec les réponses des autres clients ou simulée
+    sid = request.sid
+    verdict = progress_manager.evaluate_answer(data)
+    verdict.add_done_callback(lambda future: send_evaluation(sid, future))
+
+def send_evaluation(sid, future):
+    """
+    Met à jour la progression du client avec l'évaluation de sa réponse et la lui envoie
     
-    user_data = user_progress[request.sid]
-    user_data['total_answers'] += 1
+    Args:
+        sid (str): Identifiant de session du client
+        future (Future): Correction de la réponse, voir ProgressManager.evaluate_answer
+    """
+    try:
+        is_correct, _ = future.result()
+    except Exception:
+        # Réponse non corrigée, elle n'est pas comptée
+        user_data = user_progress.get(sid)
+        if user_data is None:
+            return
+        socketio.emit('progress_update', {
+            'type': 'progress_update',
+            'progress': user_data.progress,
+            'increment': 0,
+            'message': '⚠️ Correction indisponible, réessayez dans un instant.',
+            'reward': None,
+            'accuracy': user_data.accuracy
+        }, to=sid)
+        return
     
-    # Évaluer la réponse avec l'IA simulée
-    evaluation = progress_manager.evaluate_answer(data)
+    recorded = user_progress.record_answer(sid, is_correct, progress_manager.score)
+    if recorded is None:
+        # Corrigée après la déconnexion du client, sa progression a déjà été sauvegardée
+        print(f'🔌 Correction ignorée, client déconnecté: {sid}')
+        return
+    user_data, evaluation, new_checkpoints = recorded
+    save_progress(sid, user_data)
     
     if evaluation['success']:
-        user_data['correct_answers'] += 1
-        
-        # Mettre à jour la progression
-        new_progress = min(user_data['progress'] + evaluation['progress_increment'], 100)
-        user_data['progress'] = new_progress
-        
-        # Vérifier les nouveaux checkpoints atteints
-        checkpoints = [25, 50, 75, 100]
-        new_checkpoints = []
-        
-        for checkpoint in checkpoints:
-            if (new_progress >= checkpoint and 
-                checkpoint not in user_data['checkpoints_reached']):
-                user_data['checkpoints_reached'].append(checkpoint)
-                new_checkpoints.append(checkpoint)
-        
         # Préparer la réponse
         response_data = {
             'type': 'progress_update',
-            'progress': new_progress,
+            'progress': user_data.progress,
             'increment': evaluation['progress_increment'],
             'message': evaluation['message'],
             'reward': evaluation['reward'],
             'streak': evaluation['streak'],
             'new_checkpoints': new_checkpoints,
-            'accuracy': (user_data['correct_answers'] / user_data['total_answers']) * 100
+            'accuracy': user_data.accuracy
         }
         
         # Ajouter des messages spéciaux pour les checkpoints
@@ -187,49 +904,38 @@ def handle_answer_submission(data):
                 else:
                     response_data['special_message'] = f'⭐ Checkpoint {checkpoint}% débloqué !'
         
-        print(f'✅ Progression mise à jour: {new_progress}% (+{evaluation["progress_increment"]}%)')
+        print(f'✅ Progression mise à jour: {user_data.progress}% (+{evaluation["progress_increment"]}%)')
         
     else:
         # Réponse incorrecte
         response_data = {
             'type': 'progress_update',
-            'progress': user_data['progress'],
+            'progress': user_data.progress,
             'increment': 0,
             'message': evaluation['message'],
             'reward': None,
             'streak': 0,
-            'accuracy': (user_data['correct_answers'] / user_data['total_answers']) * 100
+            'accuracy': user_data.accuracy
         }
         
-        print(f'❌ Réponse incorrecte - Progression inchangée: {user_data["progress"]}%')
+        print(f'❌ Réponse incorrecte - Progression inchangée: {user_data.progress}%')
     
-    # Envoyer la mise à jour au client
-    emit('progress_update', response_data)
+    # Envoyer la mise à jour au client, depuis ce processus ou un autre via la file de messages
+    socketio.emit('progress_update', response_data, to=sid)
 
 @socketio.on('reset_progress')
 def handle_reset_progress():
-    """Remet à zéro la progression d'un utilisateur"""
+    """Remet à zéro la progression d'un utilisateur, streak et difficulté compris"""
     print(f'🔄 Remise à zéro demandée par {request.sid}')
     
-    if request.sid in user_progress:
-        user_progress[request.sid] = {
-            'progress': 0,
-            'checkpoints_reached': [],
-            'start_time': time.time(),
-            'total_answers': 0,
-            'correct_answers': 0
-        }
-        
-        # Réinitialiser le gestionnaire de progression
-        global progress_manager
-        progress_manager = ProgressManager()
-        
-        emit('progress_update', {
-            'type': 'progress_update',
-            'progress': 0,
-            'message': '🔄 Progression remise à zéro - C\'est reparti !',
-            'reward': None
-        })
+    save_progress(request.sid, user_progress.reset(request.sid))
+    
+    emit('progress_update', {
+        'type': 'progress_update',
+        'progress': 0,
+        'message': '🔄 Progression remise à zéro - C\'est reparti !',
+        'reward': None
+    })
 
 @app.route('/')
 def index():
@@ -237,46 +943,31 @@ def index():
     return {
         'status': 'Serveur WebSocket Duolingo actif',
         'connected_users': len(user_progress),
-        'endpoint': 'ws://localhost:8001',
+        'endpoint': f'ws://localhost:{PROGRESS_SERVER_PORT}',
         'frontend_url': 'http://localhost:3000'
     }
 
 @app.route('/stats')
 def get_stats():
     """Statistiques globales du serveur"""
-    total_users = len(user_progress)
-    
-    if total_users == 0:
-        return {
-            'total_users': 0,
-            'average_progress': 0,
-            'total_answers': 0,
-            'global_accuracy': 0
-        }
-    
-    total_progress = sum(data['progress'] for data in user_progress.values())
-    total_answers = sum(data['total_answers'] for data in user_progress.values())
-    total_correct = sum(data['correct_answers'] for data in user_progress.values())
-    
-    return {
-        'total_users': total_users,
-        'average_progress': total_progress / total_users,
-        'total_answers': total_answers,
-        'global_accuracy': (total_correct / max(total_answers, 1)) * 100,
-        'users_at_100_percent': len([d for d in user_progress.values() if d['progress'] >= 100])
-    }
+    stats = user_progress.stats()
+    if grading_service is not None:
+        stats['grading'] = grading_service.stats()
+    return stats
 
 if __name__ == '__main__':
     print('🚀 Démarrage du serveur WebSocket Duolingo...')
-    print('📡 Backend accessible sur: http://localhost:8001')
+    print(f'📡 Backend accessible sur: http://localhost:{PROGRESS_SERVER_PORT}')
     print('🌐 Frontend à connecter sur: http://localhost:3000')
-    print('📊 Statistiques disponibles sur: http://localhost:8001/stats')
+    print(f'📊 Statistiques disponibles sur: http://localhost:{PROGRESS_SERVER_PORT}/stats')
     
     # Démarrer le serveur avec support WebSocket
+    # Plusieurs processus peuvent tourner sur des ports différents derrière un répartiteur de
+    # charge, avec PROGRESS_STORE_URL et SOCKETIO_MESSAGE_QUEUE pointant vers le même serveur
     socketio.run(
         app, 
         host='0.0.0.0', 
-        port=8001, 
+        port=PROGRESS_SERVER_PORT, 
         debug=True,
         allow_unsafe_werkzeug=True
     )
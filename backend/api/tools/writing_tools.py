@@ -0,0 +1,250 @@
+# /usr/bin/python3
+import re
+from smolagents import CodeAgent, WebSearchTool, Tool
+from smolagents.memory import FinalAnswerStep
+from smolagents.models import ChatMessageStreamDelta
+from .cancellation import CancelledRun, check_cancelled, current_token
+from .agent import emit_event, is_streamed, model_registry, report_manager_step, with_user_state
+from .llm_cache import response_cache
+from .models import AgentPool
+from .session_logs import logger
+
+"""
+Writer tools and the CodeAgents running them.
+
+Everything depending on smolagents lives here, so that importing the agent
+module stays cheap: this module is only imported by the first run that needs
+an agent, or by the warm-up thread of the app.
+"""
+
+
+def run_cached_writer(role: str, prompt: str) -> str:
+    """Runs a writer agent of the pool of the role, reusing the cached response to an identical prompt if any."""
+    model = model_registry.get(role)
+
+    def compute() -> str:
+        with agent_pools[role].checkout() as writer:
+            return run_writer(writer, prompt)
+
+    answer, cached = response_cache.get_or_compute(
+        model.model_id, model.kwargs.get("temperature"), prompt, compute
+    )
+    if cached:
+        logger.info("Writer answer served from the response cache.")
+        emit_event({"event": "token", "text": answer})
+    return answer
+
+
+# Escapes of Python string literals decoded while streaming, others are kept as written
+STRING_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "\\": "\\", "'": "'", '"': '"', "\n": ""}
+
+
+class FinalAnswerText:
+    """
+    Extracts the text passed to final_answer from the code of a writer agent as it
+    streams in, so that the learner sees the answer being written and not the code.
+    Only a plain string literal argument is streamed, e.g. final_answer("..."); any other
+    argument is only sent with the result of the run.
+    """
+
+    START = re.compile(r"final_answer\(\s*(?:answer\s*=\s*)?([rRuU]?)(\"\"\"|'''|\"|')")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets the code streamed so far, at the start of a new step of the agent."""
+        self._code = ""
+        self._quote = None
+        self._raw = False
+        self._position = 0
+        self._closed = False
+
+    def feed(self, chunk: str) -> str:
+        """Adds a chunk of the streamed code, returns the new text of the answer, if any."""
+        self._code += chunk
+        if self._closed:
+            return ""
+        if self._quote is None:
+            match = self.START.search(self._code)
+            # A single quote could still be the start of a triple one
+            if match is None or (len(match.group(2)) == 1 and len(self._code) - match.end() < 2):
+                return ""
+            self._raw = match.group(1).lower() == "r"
+            self._quote = match.group(2)
+            self._position = match.end()
+
+        code, text, index = self._code, [], self._position
+        while index < len(code):
+            if code.startswith(self._quote, index):
+                self._closed = True
+                break
+            if self._quote.startswith(code[index:]):
+                break  # Maybe the start of the closing quote, wait for the next chunk
+            if code[index] == "\\":
+                if index + 1 == len(code):
+                    break  # Wait for the escaped character
+                escaped = code[index + 1]
+                if self._raw or escaped not in STRING_ESCAPES:
+                    text.append(code[index : index + 2])
+                else:
+                    text.append(STRING_ESCAPES[escaped])
+                index += 2
+                continue
+            text.append(code[index])
+            index += 1
+        self._position = index
+        return "".join(text)
+
+
+def run_writer(writer: CodeAgent, prompt: str) -> str:
+    """
+    Runs a writer agent, streaming the text of its answer if the current run is streamed.
+
+    Cancellable runs are streamed too, so that a cancelled run stops reading the
+    response of the LLM between two tokens and closes its request.
+    """
+    token = current_token()
+    if not is_streamed() and token is None:
+        return writer.run(prompt)
+    answer = None
+    final_answer_text = FinalAnswerText()
+    events = writer.run(prompt, stream=True)
+    try:
+        for event in events:
+            if token is not None and token.cancelled:
+                raise CancelledRun("Writer run cancelled")
+            if isinstance(event, ChatMessageStreamDelta):
+                text = final_answer_text.feed(event.content) if event.content else ""
+                if text:
+                    emit_event({"event": "token", "text": text})
+            elif isinstance(event, FinalAnswerStep):
+                answer = event.output
+            else:
+                # The end of a step, the next one streams new code
+                final_answer_text.reset()
+    finally:
+        events.close()
+    return answer
+
+
+def run_manager(manager: CodeAgent, prompt: str):
+    """
+    Runs the manager agent and returns its answer.
+
+    In a cancellable run its model calls are streamed, so that a cancelled run stops
+    reading the response of the LLM between two chunks and closes its request, instead
+    of only stopping between steps. Nothing is forwarded: the manager only writes code.
+    """
+    token = current_token()
+    if token is None:
+        return manager.run(prompt)
+    answer = None
+    events = manager.run(prompt, stream=True)
+    try:
+        for event in events:
+            if token.cancelled:
+                raise CancelledRun("Manager run cancelled")
+            if isinstance(event, FinalAnswerStep):
+                answer = event.output
+    finally:
+        events.close()
+    return answer
+
+
+class CourseWritingTool(Tool):
+    name = "course_writing_tool"
+    description = """This tool is responsible for explaining large concepts to the user. If the user seems stuck on some specific content, the course_writing_tool would be interesting to use to explain the user the concept he is lacking.  It is also used to answer the user's questions about the course, such as 'What is a Markov Chain?' or 'What is Young's double-slit experiment?'. The course_writing_tool is also used to explain the course step by step, and to answer the user's questions about the course."""
+
+    inputs = {
+        "context": {
+            "type": "string",
+            "description": "The context of the conversation, including the user's level of understanding, previous messages, and any relevant information the course_writing_tool could use. This context will be used to tailor the explanation to the user's needs.",
+        },
+        "topic": {
+            "type": "string",
+            "description": "The specific topic of the course to explain, as a single point to explain. For example, 'Transition matrices in Markov Chains' or 'The principle of Young's double-slit experiment'.",
+        },
+    }
+
+    output_type = "string"
+
+    def forward(self, context: str, topic: str) -> str:
+        check_cancelled()
+        context = with_user_state(context)
+        prompt = """### SYSTEM PROMPT ###\nYou are a helpful agent that writes courses on various topics. You will be given a context of the conversation and a topic to explain. Your task is to write a course text about the topic, using the context to tailor your explanation to the user's needs.\n\n### CONTEXT ###\n{context}\n\n### TOPIC ###\n{topic}\n\n### SYSTEM PROMPT ###\nDo NOT complain, do NOT ask for more information on your task, and do NOT answer as a chatbot. You should answer a short text about on the given topic. You should only use web search if you cannot come up with any course content by yourself or make sure you are right about a complex point, otherwise, you HAVE to return in a single run. If necessary, can think about a full course but should only teach about ONE SINGLE point of the course; as follow up points can be discussed later.\n\n### OUTPUT FORMAT ###\nReturn a short text explaining the topic, the size of a paragraph but using line skips, using the context to tailor your explanation to the user's needs. Do not include any additional information or explanations, just the course content on a single topic. Feel free to use LaTeX syntax, using $ as bounds, e.g. $e^{{-ix^2}} + u_2 = 6 \\times 4$; also make sure to escape the backslash character
+        """.format(context=context, topic=topic)
+        emit_event({"event": "step", "type": "tool", "tool": self.name, "topic": topic})
+        return run_cached_writer("course", prompt)
+
+
+class QuestionWritingTool(Tool):
+    name = "question_writing_tool"
+    description = """This tool is responsible for asking questions to the user to verify the user's understanding of the course. When the user seems to have understood the course, the question_writing_tool will ask questions to verify the user's understanding. If the user seems to be stuck on some specific content, the question_writing_tool will ask questions to help the user understand the concept he is lacking. The question_writing_tool is also used to ask questions about the user's understanding of the course, such as 'Do you feel like you completely understand what a Markov Chain is?' or 'Do you know the principle behind Young's double-slit experiment?'. The question_writing_tool should only return a single question, and should not complain or ask for more information on its task."""
+
+    inputs = {
+        "context": {
+            "type": "string",
+            "description": "The context of the conversation, including the user's level of understanding, previous messages, and any relevant information the question_writing_tool could use. This context will be used to tailor the question to the user's needs.",
+        },
+        "topic": {
+            "type": "string",
+            "description": "The specific topic of the course to ask a question about, as a single point to ask about. For example, 'Transition matrices in Markov Chains' or 'The principle of Young's double-slit experiment'.",
+        },
+    }
+
+    output_type = "string"
+
+    def forward(self, context: str, topic: str) -> str:
+        check_cancelled()
+        context = with_user_state(context)
+        prompt = """### SYSTEM PROMPT ###\nYou are a helpful agent that writes questions on various topics. You will be given a context of the conversation and a topic to ask a question about. Your task is to write a question about the topic, using the context to tailor your question to the user's needs.\n\n### CONTEXT ###\n{context}\n\n### TOPIC ###\n{topic}\n\n### SYSTEM PROMPT ###\nDo NOT complain, do NOT ask for more information on your task, and do NOT answer as a chatbot. You should write a question about a SINGLE topic. You should only use web search if you cannot come up with any question by yourself or make sure you are right about a complex point, otherwise, you HAVE to return in a single run. If necessary, can think about a full course but should only ask ONE SINGLE question about the course, as a single point; as follow up points can be discussed later.\n\n### OUTPUT FORMAT ###\nReturn a single question asking about the topic, using the context to tailor your question to the user's needs. Do not include any additional information or explanations, just the question. Feel free to use LaTeX syntax, using $ as bounds, e.g. $e^{{-ix^2}} + u_2 = 6 \\times 4$\n; also make sure to escape the backslash character.
+      """.format(context=context, topic=topic)
+        emit_event({"event": "step", "type": "tool", "tool": self.name, "topic": topic})
+        return run_cached_writer("question", prompt)
+
+
+def build_course_agent() -> CodeAgent:
+    return CodeAgent(
+        model=model_registry.get("course"),
+        tools=[WebSearchTool()],
+        max_steps=3,
+        stream_outputs=True,  # Lets run_writer forward tokens to streamed runs
+    )
+
+
+def build_question_agent() -> CodeAgent:
+    return CodeAgent(
+        model=model_registry.get("question"),
+        tools=[WebSearchTool()],
+        max_steps=3,
+        stream_outputs=True,
+    )
+
+
+def build_manager_agent() -> CodeAgent:
+    return CodeAgent(
+        model=model_registry.get("manager"),
+        name="manager_agent",
+        description="This Agent is responsible for managing the conversation between the user and the course_agent and question_agent. It decides which agent to use based on the user's input and the context of the conversation. The manager_agent can also choose not to do anything if it believes it wouldn't help the user, or the user did not write enough to warrant an answer.",
+        tools=[CourseWritingTool(), QuestionWritingTool()],
+        max_steps=5,
+        step_callbacks=[report_manager_step],
+        stream_outputs=True,  # Lets run_manager stop a cancelled run between two tokens
+        # Tool calls run in the manager's thread, so they can reach the event sink
+        executor_kwargs={"timeout_seconds": None},
+    )
+
+
+# Each run checks out its own agent, since agents keep their step memory while running
+agent_pools = {
+    "course": AgentPool(build_course_agent),
+    "question": AgentPool(build_question_agent),
+    "manager": AgentPool(build_manager_agent),
+}
+
+# Writers called directly by the structured router, by balise of their answer
+writing_tools = {
+    "cours": CourseWritingTool(),
+    "question": QuestionWritingTool(),
+}
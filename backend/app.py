@@ -1,7 +1,7 @@
 # /usr/bin/python3
 from flask import Flask
 from flask_cors import CORS
-from api.routes import api
+from api.routes import api, start_warm_up
 from os import path, getenv
 import dotenv
 
@@ -28,17 +28,27 @@ class Config:
     API_TITLE = "Agents Workflow"
     API_VERSION = "v1"
 
+    # Import heavy dependencies in a background thread at startup, instead of on first use
+    WARM_UP = getenv("WARM_UP", "1") != "0"
+
 
 def create_app(config_class=Config):
     app = Flask(__name__, static_folder="static")
     app.config.from_object(config_class)
 
     # Enable CORS
-    CORS(app, resources={r"/api/*": {"origins": app.config["CORS_ORIGINS"]}})
+    CORS(
+        app,
+        resources={r"/api/*": {"origins": app.config["CORS_ORIGINS"]}},
+        expose_headers=["ETag", "X-Session-Id", "X-Coalesced"],
+    )
 
     # Register blueprints
     app.register_blueprint(api, url_prefix="/api")
 
+    if app.config["WARM_UP"]:
+        start_warm_up()
+
     return app
 
 
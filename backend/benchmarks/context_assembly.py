@@ -0,0 +1,117 @@
+# /usr/bin/python3
+"""
+Benchmark of the per-request context assembly cost of /api/body.
+
+Simulates a learner writing a document one block at a time, up to 1,000
+blocks, and measures the time spent building the prompt context on each
+request, for the legacy full rebuild (sort + translate_json + anthropify_body +
+stringify_context) and for the incremental DocumentContext. Its update
+(set_block) has a flat cost per request, which is checked; its render still
+copies the whole document into the returned string, so it grows linearly.
+
+Usage: python benchmarks/context_assembly.py [n_blocks]
+"""
+import sys
+import time
+from statistics import median
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from api.tools.agent import Agent, translate_json, anthropify_body  # noqa: E402
+from api.tools.document import DocumentContext, USER_RESPONSE_BALISE  # noqa: E402
+
+BLOCK_TEXT = "Some paragraph written in the document, long enough to be realistic. " * 5
+CHECKPOINTS = (10, 100, 250, 500, 1000)
+FLAT_WINDOW = 50  # Requests whose median update cost is compared
+FLAT_FACTOR = 2.0  # Maximum ratio of the late to the early median update cost
+
+
+def block(i: int) -> dict:
+    balise = USER_RESPONSE_BALISE if i % 3 else "cours"
+    return {"text": f"{i}: {BLOCK_TEXT}", "balise": balise}
+
+
+def legacy_request(text_blocks: dict, block_id: int, new_block: dict) -> str:
+    text_blocks[block_id] = new_block
+    body = [text_blocks[key] for key in sorted(text_blocks.keys())]
+    return Agent().stringify_context(anthropify_body(translate_json(body)))
+
+
+def incremental_request(document: DocumentContext, block_id: int, new_block: dict) -> str:
+    document.set_block(block_id, new_block["text"], new_block["balise"])
+    return document.render()
+
+
+def mean_us(timings: list[float]) -> float:
+    return 1e6 * sum(timings) / len(timings)
+
+
+def run(n_blocks: int):
+    text_blocks = dict()
+    document = DocumentContext()
+    timings = {"legacy": [], "update": [], "render": []}
+
+    for i in range(n_blocks):
+        new_block = block(i)
+        start = time.perf_counter()
+        legacy = legacy_request(text_blocks, i, new_block)
+        timings["legacy"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        document.set_block(i, new_block["text"], new_block["balise"])
+        timings["update"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        incremental = document.render()
+        timings["render"].append(time.perf_counter() - start)
+
+        if legacy != incremental:
+            raise AssertionError(f"Rendered contexts differ after block {i}")
+
+    print("Appending blocks, mean cost per request over the last 10 requests (µs):")
+    print(f"{'blocks':>8} {'legacy':>12} {'update':>12} {'render':>12}")
+    for checkpoint in CHECKPOINTS:
+        if checkpoint > n_blocks:
+            break
+        window = slice(max(checkpoint - 10, 0), checkpoint)
+        print(
+            f"{checkpoint:>8} {mean_us(timings['legacy'][window]):>12.1f}"
+            f" {mean_us(timings['update'][window]):>12.1f}"
+            f" {mean_us(timings['render'][window]):>12.1f}"
+        )
+
+    # The update must not grow with the document, unlike the render copying it. Timed on
+    # its own, as the render copies interleaved above disturb the CPU caches.
+    if n_blocks >= 4 * FLAT_WINDOW:
+        updates = []
+        document_only = DocumentContext()
+        for i in range(n_blocks):
+            new_block = block(i)
+            start = time.perf_counter()
+            document_only.set_block(i, new_block["text"], new_block["balise"])
+            updates.append(time.perf_counter() - start)
+        early = median(updates[FLAT_WINDOW : 2 * FLAT_WINDOW])
+        late = median(updates[-FLAT_WINDOW:])
+        print(
+            f"\nMedian update cost alone (µs): {1e6 * early:.1f} at {2 * FLAT_WINDOW} blocks,"
+            f" {1e6 * late:.1f} at {n_blocks} blocks"
+        )
+        if late > FLAT_FACTOR * early:
+            raise AssertionError(f"Update cost grew {late / early:.1f}x from {2 * FLAT_WINDOW} to {n_blocks} blocks")
+
+    # Editing a block in the middle of a full document
+    repeats = 100
+    middle = n_blocks // 2
+    start = time.perf_counter()
+    for r in range(repeats):
+        legacy_request(text_blocks, middle, {"text": f"edit {r}", "balise": USER_RESPONSE_BALISE})
+    legacy = 1e6 * (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for r in range(repeats):
+        incremental_request(document, middle, {"text": f"edit {r}", "balise": USER_RESPONSE_BALISE})
+    incremental = 1e6 * (time.perf_counter() - start) / repeats
+    print(f"\nEditing block {middle} of {n_blocks} (µs): legacy {legacy:.1f}, incremental {incremental:.1f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,317 @@
+# /usr/bin/python3
+"""
+Load test of the backend with a fake LLM.
+
+Boots create_app() with every LiteLLMModel replaced by a stub that answers
+offline after a configurable latency and token rate, and fails a configurable
+share of its calls. Simulated learners then go concurrently through
+/api/init, several /api/body submissions and an /api/plot, and the Socket.IO
+progress server is loaded with answer submissions graded in batches by the
+same stub. Reports the throughput and the p50/p95/p99 latency of each
+endpoint, to compare runs before deploying.
+
+Usage: python benchmarks/load_test.py [--learners N] [--bodies N] [--latency S] ...
+(see --help)
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import dup, dup2, environ, path
+
+BACKEND_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+TOOLS_DIR = path.join(BACKEND_DIR, "api", "tools")
+
+# Everything stays offline and out of the working tree
+STATE_DIR = tempfile.mkdtemp(prefix="load_test_")
+environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+environ.setdefault("LOG_DIR", path.join(STATE_DIR, "logs"))
+environ.setdefault("PROGRESS_DB_PATH", path.join(STATE_DIR, "progress.db"))
+environ.setdefault("GRADING_MODEL", "stub/grader")
+environ.setdefault("WARM_UP", "0")
+OUTPUT_LOG = path.join(STATE_DIR, "output.log")
+
+WORDS = "the derivative of a function measures how its value changes when its input changes".split()
+SUBJECTS = ["Mathematics", "Physics", "Chemistry", "Biology", "Computer Science"]
+POLL_INTERVAL = 0.002  # Seconds between two checks of a Socket.IO client's received events
+
+
+class StubSettings:
+    """Behaviour of the stub LLM, shared by all the stub models."""
+
+    latency = 0.5  # Seconds before the first token
+    token_rate = 200.0  # Output tokens per second
+    failure_rate = 0.0  # Share of the calls failing
+    output_tokens = 120  # Tokens of a prose answer
+
+
+def message_text(message) -> str:
+    content = message["content"] if isinstance(message, dict) else message.content
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def prose(tokens: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(tokens))
+
+
+def stub_answer(messages: list, response_format: dict = None) -> str:
+    """Answers in the shape each caller of the LLM expects."""
+    text = "\n".join(message_text(message) for message in messages)
+    schema = (response_format or {}).get("json_schema", {}).get("name")
+    if schema == "route":
+        return json.dumps({"balise": random.choice(["cours", "question"]), "topic": random.choice(WORDS)})
+    if schema == "grades":
+        answers = len(re.findall(r"^\d+\. ", text.split("### ANSWERS ###")[-1], re.MULTILINE))
+        return json.dumps({"correct": [random.random() > 0.3 for _ in range(answers)]})
+    if "[%QE%]" in text:
+        return "[%QE%]"
+    if "final_answer" in text:
+        # A CodeAgent: a writer returns its text, the manager its {"balise", "text"} answer
+        if "### TOPIC ###" in text:
+            answer = repr(prose(StubSettings.output_tokens))
+        else:
+            answer = repr({"balise": "cours", "text": prose(StubSettings.output_tokens)})
+        return f"Thought: I can answer directly.\n<code>\nfinal_answer({answer})\n</code>"
+    return prose(StubSettings.output_tokens)
+
+
+def make_stub_model():
+    """Subclass of LiteLLMModel answering offline, see StubSettings."""
+    from smolagents import LiteLLMModel
+    from smolagents.models import ChatMessage, ChatMessageStreamDelta, MessageRole
+    from smolagents.monitoring import TokenUsage
+
+    class StubLiteLLMModel(LiteLLMModel):
+        def _answer(self, messages, stop_sequences, response_format) -> tuple[str, TokenUsage]:
+            time.sleep(StubSettings.latency)
+            if random.random() < StubSettings.failure_rate:
+                raise RuntimeError("Stub LLM failure")
+            content = stub_answer(messages, response_format)
+            for stop in stop_sequences or []:
+                content = content.split(stop)[0]
+            usage = TokenUsage(
+                input_tokens=sum(len(message_text(message)) for message in messages) // 4,
+                output_tokens=len(content) // 4 + 1,
+            )
+            return content, usage
+
+        def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+            content, usage = self._answer(messages, stop_sequences, response_format)
+            time.sleep(usage.output_tokens / StubSettings.token_rate)
+            return ChatMessage(role=MessageRole.ASSISTANT, content=content, token_usage=usage)
+
+        def generate_stream(
+            self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs
+        ):
+            content, usage = self._answer(messages, stop_sequences, response_format)
+            chunks = re.findall(r"\S*\s*", content)
+            for chunk in chunks:
+                if chunk:
+                    time.sleep(1 / StubSettings.token_rate)
+                    yield ChatMessageStreamDelta(content=chunk)
+            yield ChatMessageStreamDelta(content="", token_usage=usage)
+
+    return StubLiteLLMModel
+
+
+class Recorder:
+    """Latencies and errors of each endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, latency: float, ok: bool):
+        with self._lock:
+            self.latencies[name].append(latency)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, duration: float, file):
+        print(
+            f"  {'endpoint':<22} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}",
+            file=file,
+        )
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (50, 95, 99))
+            print(
+                f"  {name:<22} {len(latencies):>8} {self.errors[name]:>7} {len(latencies) / duration:>8.1f}"
+                f" {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}",
+                file=file,
+            )
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def timed(recorder: Recorder, name: str, request, is_ok) -> object:
+    start = time.perf_counter()
+    try:
+        response = request()
+    except Exception:
+        recorder.add(name, time.perf_counter() - start, False)
+        return None
+    recorder.add(name, time.perf_counter() - start, is_ok(response))
+    return response
+
+
+def run_learner(flask_app, recorder: Recorder, index: int, bodies: int, think: float):
+    """One learner: questionnaire, submissions of text blocks, then a plot."""
+    client = flask_app.test_client()
+    subject = SUBJECTS[index % len(SUBJECTS)]
+    response = timed(
+        recorder,
+        "/api/init",
+        lambda: client.post(
+            "/api/init",
+            json={
+                "name": f"Learner {index}",
+                "educationLevel": {"item": "Bachelor", "index": 3},
+                "selectedSubjects": [{"name": subject, "topics": ["Basics"]}],
+                "selectedTopics": ["Basics"],
+            },
+        ),
+        lambda response: response.status_code == 200 and response.json.get("success"),
+    )
+    if response is None or response.status_code != 200:
+        return
+    headers = {"X-Session-Id": response.json["session_id"]}
+
+    for block in range(bodies):
+        time.sleep(think)
+        timed(
+            recorder,
+            "/api/body",
+            lambda: client.post(
+                "/api/body",
+                headers=headers,
+                json={
+                    "id": block,
+                    "text": f"Learner {index} about {subject}: {prose(20)}",
+                    "balise": "human_response",
+                },
+            ),
+            # Failed runs are answered with the failure image
+            lambda response: response.status_code == 200 and response.json.get("balise") != "media_image",
+        )
+
+    timed(
+        recorder,
+        "/api/plot",
+        lambda: client.post(
+            "/api/plot", json={"text": f"f(x) = sin({index % 7 + 1}*x) + x**2", "xMin": -5, "xMax": 5}
+        ),
+        lambda response: response.status_code == 200,
+    )
+
+
+def run_progress_client(progress_server, recorder: Recorder, answers: int, think: float):
+    """One Socket.IO client of the progress server, timing each answer until its progress_update."""
+    client = progress_server.socketio.test_client(progress_server.app)
+    client.get_received()
+    for _ in range(answers):
+        time.sleep(think)
+        start = time.perf_counter()
+        client.emit("answer_submission", {"question": "What is 6 * 7?", "answer": random.choice(["42", "41"])})
+        received = []
+        while not received and time.perf_counter() - start < 30:
+            time.sleep(POLL_INTERVAL)
+            received = client.get_received()
+        ok = bool(received) and not received[0]["args"][0]["message"].startswith("⚠️")
+        recorder.add("socket answer", time.perf_counter() - start, ok)
+    client.disconnect()
+
+
+def redirect_output():
+    """
+    Sends what the app and the agents print, down to the file descriptors, to OUTPUT_LOG
+    for the rest of the process (background prefetches keep printing after a phase), and
+    returns a stream to the original stdout for the report.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    report = open(dup(1), "w", buffering=1)
+    output = open(OUTPUT_LOG, "a", buffering=1)
+    dup2(output.fileno(), 1)
+    dup2(output.fileno(), 2)
+    sys.stdout = sys.stderr = output
+    return report
+
+
+def run_phase(title: str, workers: int, job, report):
+    recorder = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(job, recorder, index) for index in range(workers)]:
+            future.result()
+    duration = time.perf_counter() - start
+    print(f"\n{title} ({duration:.1f} s)", file=report)
+    recorder.report(duration, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the backend with a fake LLM.")
+    parser.add_argument("--learners", type=int, default=20, help="concurrent simulated learners")
+    parser.add_argument("--bodies", type=int, default=5, help="/api/body submissions per learner")
+    parser.add_argument("--think", type=float, default=0.1, help="seconds between two actions of a learner")
+    parser.add_argument("--latency", type=float, default=StubSettings.latency, help="stub LLM seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=StubSettings.token_rate, help="stub LLM output tokens per second")
+    parser.add_argument("--failure-rate", type=float, default=StubSettings.failure_rate, help="share of stub LLM calls failing")
+    parser.add_argument("--socket-clients", type=int, default=50, help="concurrent progress server clients")
+    parser.add_argument("--answers", type=int, default=10, help="answers submitted per progress server client")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    StubSettings.latency = args.latency
+    StubSettings.token_rate = args.token_rate
+    StubSettings.failure_rate = args.failure_rate
+    random.seed(args.seed)
+    report = redirect_output()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import smolagents
+
+    # ModelRegistry and the grader of the progress server look LiteLLMModel up when building a model
+    smolagents.LiteLLMModel = make_stub_model()
+    import app
+
+    flask_app = app.create_app()
+    print(
+        f"Stub LLM: {args.latency * 1000:.0f} ms latency, {args.token_rate:.0f} tokens/s, "
+        f"{args.failure_rate:.0%} failures. Output and state in {STATE_DIR}",
+        file=report,
+    )
+    run_phase(
+        f"{args.learners} learners, {args.bodies} submissions each",
+        args.learners,
+        lambda recorder, index: run_learner(flask_app, recorder, index, args.bodies, args.think),
+        report,
+    )
+
+    sys.path.insert(0, TOOLS_DIR)
+    import websocket_progress_server
+
+    run_phase(
+        f"Progress server, {args.socket_clients} clients, {args.answers} answers each",
+        args.socket_clients,
+        lambda recorder, index: run_progress_client(websocket_progress_server, recorder, args.answers, args.think),
+        report,
+    )
+    grading = websocket_progress_server.app.test_client().get("/stats").json.get("grading")
+    print(f"  grading: {grading}", file=report)
+
+
+if __name__ == "__main__":
+    main()
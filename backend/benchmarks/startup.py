@@ -0,0 +1,90 @@
+# /usr/bin/python3
+"""
+Benchmark of the cold start of a backend worker.
+
+Each measurement runs in a fresh interpreter and reports the time to import
+the app, to create it, and the latency of the first request to a few
+endpoints, with and without the background warm-up of heavy dependencies
+(the warm-up run waits a moment after startup, as a worker would before
+receiving traffic). The import time is checked against a budget, and the
+script exits with status 1 when it is exceeded, so it can guard against
+regressions in CI.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+from os import environ, path
+
+BACKEND_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+IMPORT_BUDGET = 0.5  # Seconds allowed to import the app
+WARM_UP_WAIT = 5.0  # Seconds left to the warm-up before the first request
+
+REQUESTS = {
+    "/api/process": {"text": "hello"},
+    "/api/init": {"name": "Ada", "educationLevel": {"item": "Bachelor", "index": 3}},
+    "/api/plot": {"text": "f(x) = sin(x)", "xMin": -5, "xMax": 5},
+}
+
+
+def measure(warm_up: bool) -> dict:
+    """Runs in the child interpreter, returns its timings in seconds."""
+    timings = dict()
+    start = time.perf_counter()
+    import app  # noqa: F401
+
+    timings["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flask_app = app.create_app()
+    timings["create_app"] = time.perf_counter() - start
+    if warm_up:
+        time.sleep(WARM_UP_WAIT)
+
+    client = flask_app.test_client()
+    for url, body in REQUESTS.items():
+        start = time.perf_counter()
+        response = client.post(url, json=body)
+        timings[url] = time.perf_counter() - start
+        assert response.status_code == 200, f"{url} returned {response.status_code}"
+    return timings
+
+
+def run_child(warm_up: bool) -> dict:
+    env = dict(environ, WARM_UP="1" if warm_up else "0")
+    output = subprocess.run(
+        [sys.executable, path.abspath(__file__), "--child", str(int(warm_up))],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    # The app prints its own messages, the timings are on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs: int):
+    over_budget = False
+    for warm_up in (False, True):
+        results = [run_child(warm_up) for _ in range(runs)]
+        print(f"\nWarm-up {'on' if warm_up else 'off'} (median of {runs} runs)")
+        for name in results[0]:
+            median = statistics.median(result[name] for result in results)
+            print(f"  {name:<14} {median * 1000:9.1f} ms")
+            if name == "import" and median > IMPORT_BUDGET:
+                print(f"  Import time over the budget of {IMPORT_BUDGET * 1000:.0f} ms")
+                over_budget = True
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        sys.path.insert(0, BACKEND_DIR)
+        print(json.dumps(measure(warm_up=sys.argv[2] == "1")))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
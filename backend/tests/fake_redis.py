@@ -0,0 +1,116 @@
+# /usr/bin/python3
+import threading
+
+"""
+In-process stand-in for the subset of redis-py used by RedisProgressStore.
+
+Hashes and sets only, with the optimistic transactions of redis-py: in a pipeline,
+commands run right away after WATCH and are queued after MULTI, and EXECUTE
+fails with WatchError if a watched key changed since it was watched, in which
+case Redis.transaction runs the function again.
+"""
+
+
+class WatchError(Exception):
+    pass
+
+
+class FakeRedis:
+    def __init__(self):
+        self._hashes: dict[str, dict[str, str]] = {}
+        self._sets: dict[str, set[str]] = {}
+        self._versions: dict[str, int] = {}  # Bumped on every write of a key
+        self._lock = threading.RLock()
+        self.watch_conflicts = 0  # Transactions run again because a watched key changed
+
+    def _write(self, key: str):
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def hgetall(self, key: str) -> dict:
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+    def hget(self, key: str, field: str):
+        with self._lock:
+            return self._hashes.get(key, {}).get(field)
+
+    def hset(self, key: str, mapping: dict):
+        with self._lock:
+            self._hashes.setdefault(key, {}).update({name: str(value) for name, value in mapping.items()})
+            self._write(key)
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        with self._lock:
+            values = self._hashes.setdefault(key, {})
+            values[field] = str(int(values.get(field, 0)) + amount)
+            self._write(key)
+            return int(values[field])
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                if self._hashes.pop(key, None) is not None or self._sets.pop(key, None) is not None:
+                    self._write(key)
+
+    def sadd(self, key: str, *members: str):
+        with self._lock:
+            self._sets.setdefault(key, set()).update(members)
+            self._write(key)
+
+    def srem(self, key: str, *members: str):
+        with self._lock:
+            values = self._sets.get(key, set())
+            values.difference_update(members)
+            if not values:
+                self._sets.pop(key, None)
+            self._write(key)
+
+    def smembers(self, key: str) -> set:
+        with self._lock:
+            return set(self._sets.get(key, set()))
+
+    def pipeline(self) -> "FakePipeline":
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches: str):
+        while True:
+            pipe = self.pipeline()
+            pipe.watch(*watches)
+            func(pipe)
+            try:
+                return pipe.execute()
+            except WatchError:
+                self.watch_conflicts += 1
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self._watched: dict[str, int] = {}
+        self._queue = None  # Queued commands, once MULTI was called
+
+    def watch(self, *keys: str):
+        with self.client._lock:
+            for key in keys:
+                self._watched[key] = self.client._versions.get(key, 0)
+
+    def multi(self):
+        self._queue = []
+
+    def __getattr__(self, name: str):
+        command = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            if self._queue is None:
+                return command(*args, **kwargs)
+            self._queue.append((command, args, kwargs))
+            return self
+
+        return call
+
+    def execute(self) -> list:
+        with self.client._lock:
+            for key, version in self._watched.items():
+                if self.client._versions.get(key, 0) != version:
+                    raise WatchError(key)
+            return [command(*args, **kwargs) for command, args, kwargs in self._queue or []]
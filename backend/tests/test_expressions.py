@@ -0,0 +1,103 @@
+# /usr/bin/python3
+import numpy as np
+import pytest
+
+from api.tools.expressions import ExpressionError, compile_expression
+from api.tools.plot_functions import PlotError, render_plot
+
+"""
+The expression sandbox must keep rejecting everything outside its whitelist,
+whatever the changes to the functions and syntax it supports.
+
+Usage, from backend/: python -m pytest tests
+"""
+
+X = np.array([-2.0, -0.5, 0.0, 0.5, 2.0])
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "__import__('os')",
+        "__import__('os').system('true')",
+        "open('/etc/passwd')",
+        "eval('1')",
+        "lambda: 1",
+        "(lambda x: x)(x)",
+        "x[0]",
+        "np.__dict__",
+        "x.__class__",
+        "().__class__.__bases__[0].__subclasses__()",
+        "np.load(x)",
+        "np.os",
+        "np.sin.__call__(x)",
+        "sin.__globals__",
+        "[x for x in (1,)]",
+        "{x}",
+        "'text'",
+        "True",
+        "y",
+        "sin",
+        "sin(x, x)",
+        "sin(x=x)",
+        "x := 1",
+        "x; 1",
+    ],
+)
+def test_rejects_outside_the_whitelist(expression):
+    with pytest.raises(ExpressionError):
+        compile_expression(expression)
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "(" * 1000 + "x" + ")" * 1000,
+        "-" * 100000 + "x",
+        "x+" * 100000 + "x",
+        "x<" * 5000 + "x",
+        "sin(" * 5000 + "x" + ")" * 5000,
+    ],
+)
+def test_rejects_deep_nesting(expression):
+    with pytest.raises(ExpressionError):
+        compile_expression(expression)
+
+
+def test_overflow_is_a_plot_error():
+    with pytest.raises(PlotError):
+        render_plot(compile_expression("9^9^9").source, -1.0, 1.0)
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("2x", 2 * X),
+        ("3sin(x)", 3 * np.sin(X)),
+        ("(x+1)(x-1)", (X + 1) * (X - 1)),
+        ("2pi x", 2 * np.pi * X),
+        ("x^2", X**2),
+        ("np.sin(2x)(x+1)", np.sin(2 * X) * (X + 1)),
+        ("np.floor(x)", np.floor(X)),
+        ("3", np.full_like(X, 3)),
+    ],
+)
+def test_implicit_multiplication_and_powers(expression, expected):
+    np.testing.assert_allclose(compile_expression(expression)(X), expected)
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("x^2 if x < 0 else x", np.where(X < 0, X**2, X)),
+        ("1 if -1 < x < 1 else 0", np.where((X > -1) & (X < 1), 1.0, 0.0)),
+        ("1 if x < -1 or x > 1 else 0", np.where((X < -1) | (X > 1), 1.0, 0.0)),
+        ("1 if not x > 0 and x != -2 else 0", np.where(~(X > 0) & (X != -2), 1.0, 0.0)),
+    ],
+)
+def test_conditionals_are_lowered_to_np_where(expression, expected):
+    np.testing.assert_allclose(compile_expression(expression)(X), expected)
+
+
+def test_canonical_source_ignores_layout():
+    assert compile_expression("2x^2").source == compile_expression("2 * x ** 2").source
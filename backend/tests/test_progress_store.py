@@ -0,0 +1,122 @@
+# /usr/bin/python3
+import sys
+import threading
+from os import environ, path
+
+import pytest
+
+TOOLS_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "api", "tools")
+environ["PROGRESS_DB_PATH"] = ""  # No persistence on disk
+environ.pop("PROGRESS_STORE_URL", None)
+sys.path.insert(0, TOOLS_DIR)
+
+import websocket_progress_server as server  # noqa: E402
+
+from fake_redis import FakeRedis  # noqa: E402
+
+"""
+Both progress stores must keep the same progress and aggregates; the Redis one
+runs against FakeRedis, through the same WATCH/MULTI transactions as a real server.
+
+Usage, from backend/: python -m pytest tests
+"""
+
+
+def stores():
+    return [server.MemoryProgressStore(), server.RedisProgressStore(FakeRedis())]
+
+
+def correct(record, is_correct):
+    return server.ProgressManager().score(record, is_correct)
+
+
+def test_progress_store_is_abstract():
+    with pytest.raises(TypeError):
+        server.ProgressStore()
+
+
+@pytest.mark.parametrize("store", stores(), ids=["memory", "redis"])
+def test_store_lifecycle(store):
+    store.get_or_create("a")
+    store.get_or_create("b")
+    for _ in range(3):
+        record, evaluation, _ = store.record_answer("a", True, correct)
+    assert [record.progress, record.streak] == [42, 6]
+    assert evaluation["progress_increment"] == 16
+    assert store.record_answer("b", False, correct)[0].total_answers == 1
+
+    stats = store.stats()
+    assert [len(store), stats["total_users"], stats["total_answers"]] == [2, 2, 4]
+    assert stats["average_progress"] == 21
+
+    assert store.remove("a").progress == 42
+    assert store.remove("a") is None
+    # A grade arriving after the disconnection doesn't bring the client back
+    assert store.record_answer("a", True, correct) is None
+    assert store.get("a") is None
+    assert [len(store), store.stats()["total_answers"]] == [1, 1]
+
+    store.reset("b")
+    assert store.get("b").total_answers == 0
+    assert store.stats()["total_answers"] == 0
+
+
+def test_redis_transaction_is_retried_on_conflict():
+    client = FakeRedis()
+    store = server.RedisProgressStore(client)
+    store.get_or_create("a")
+    calls = []
+
+    def score(record, is_correct):
+        calls.append(record.streak)
+        if len(calls) == 1:
+            # Another server records an answer of the same client between WATCH and EXEC
+            store.record_answer("a", True, correct)
+        return correct(record, is_correct)
+
+    record, evaluation, _ = store.record_answer("a", True, score)
+    assert client.watch_conflicts == 1
+    # Replayed with the progress written by the other server
+    assert calls == [0, 2]
+    assert [record.streak, record.total_answers, evaluation["progress_increment"]] == [4, 2, 14]
+    assert store.stats()["total_answers"] == 2
+
+
+def test_redis_concurrent_answers_keep_aggregates():
+    store = server.RedisProgressStore(FakeRedis())
+    store.get_or_create("a")
+
+    def answer():
+        for _ in range(50):
+            store.record_answer("a", False, correct)
+
+    threads = [threading.Thread(target=answer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get("a").total_answers == 400
+    assert store.stats()["total_answers"] == 400
+
+
+def test_redis_release_drops_the_clients_of_a_dead_server():
+    client = FakeRedis()
+    crashed = server.RedisProgressStore(client, server_id="host:8001")
+    other = server.RedisProgressStore(client, server_id="host:8002")
+    crashed.get_or_create("a")
+    crashed.record_answer("a", True, correct)
+    crashed.get_or_create("b")
+    other.get_or_create("c")
+    crashed.remove("b")
+
+    # The server restarts under the same id, its connections died with it
+    restarted = server.RedisProgressStore(client, server_id="host:8001")
+    restarted.release()
+    assert restarted.get("a") is None
+    assert other.get("c") is not None
+    stats = restarted.stats()
+    assert [len(restarted), stats["total_users"], stats["total_answers"], stats["average_progress"]] == [1, 1, 0, 0]
+    assert client.smembers(restarted.sids_key) == set()
+
+    restarted.release()
+    assert len(restarted) == 1
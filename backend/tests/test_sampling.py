@@ -0,0 +1,37 @@
+# /usr/bin/python3
+import numpy as np
+import pytest
+
+from api.tools.expressions import compile_expression
+from api.tools.sampling import MAX_POINTS, sample_function, sample_functions
+
+"""
+The adaptive sampling keeps to its point budget, NaN points breaking the lines included.
+
+Usage, from backend/: python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize(
+    "expression, x_min, x_max",
+    [
+        ("sin(1/x)", -1, 1),
+        ("tan(x)", -100, 100),
+        ("x**2", -5, 5),
+    ],
+)
+def test_points_stay_within_the_budget(expression, x_min, x_max):
+    x, y, _ = sample_function(compile_expression(expression), x_min, x_max)
+    assert len(x) == len(y) <= MAX_POINTS
+
+
+def test_poles_are_broken():
+    x, y, ylim = sample_function(compile_expression("1/x"), -1, 1)
+    assert np.isnan(y).any()
+    assert ylim is not None
+
+
+def test_overlay_series_stay_within_the_budget():
+    functions = [compile_expression(expression) for expression in ("sin(1/x)", "tan(x)")]
+    series, _ = sample_functions(functions, -3, 3, max_points=500)
+    assert all(len(x) == len(y) <= 500 for x, y in series)
@@ -218,26 +218,37 @@ const App: React.FC = () => {
     console.log('=== END DEBUG ===');
   };
 
+  // Starts a backend session with the questionnaire results
+  const startSession = async () => {
+    const questionnaireData = {
+      name: name,
+      educationLevel: selectedEducationLevel,
+      selectedSubjects: selectedSubjects.map(subject => ({
+        id: subject.id,
+        name: subject.name,
+        topics: subject.topics
+      })),
+      selectedTopics: selectedTopics,
+      timestamp: new Date().toISOString()
+    };
+
+    console.log('Submitting questionnaire data:', questionnaireData);
+
+    const response = await axios.post('http://localhost:8000/api/init', questionnaireData);
+
+    if (response.data.success) {
+      // Every following API call belongs to this learner's session
+      axios.defaults.headers.common['X-Session-Id'] = response.data.session_id;
+    }
+    return response;
+  };
+
   // Function to submit questionnaire results to backend
   const submitQuestionnaireResults = async () => {
     try {
       setError('');
 
-      const questionnaireData = {
-        name: name,
-        educationLevel: selectedEducationLevel,
-        selectedSubjects: selectedSubjects.map(subject => ({
-          id: subject.id,
-          name: subject.name,
-          topics: subject.topics
-        })),
-        selectedTopics: selectedTopics,
-        timestamp: new Date().toISOString()
-      };
-
-      console.log('Submitting questionnaire data:', questionnaireData);
-
-      const response = await axios.post('http://localhost:8000/api/init', questionnaireData);
+      const response = await startSession();
 
       if (response.data.success) {
         console.log('Questionnaire submitted successfully:', response.data);
@@ -624,6 +635,7 @@ const App: React.FC = () => {
             userName={name}
             selectedSubjects={selectedSubjects}
             selectedTopics={selectedTopics}
+            onSessionExpired={async () => { await startSession(); }}
           />
 
         {/* Talent Tree Section */}
@@ -1,6 +1,6 @@
 import React, { useState, useRef, useEffect } from 'react';
 import LatexRenderer from './LatexRenderer.tsx';
-import axios from 'axios';
+import axios, { AxiosResponse } from 'axios';
 
 const pageContainerStyles = `
   .page-container {
@@ -171,6 +171,8 @@ interface PageContainerProps {
   userName?: string;
   selectedSubjects?: any[];
   selectedTopics?: string[];
+  // Starts a new backend session, when the current one expired
+  onSessionExpired?: () => Promise<void>;
 }
 
 const generateUniqueId = () => {
@@ -180,7 +182,8 @@ const generateUniqueId = () => {
 const PageContainer: React.FC<PageContainerProps> = ({
   userName = 'Utilisateur',
   selectedSubjects = [],
-  selectedTopics = []
+  selectedTopics = [],
+  onSessionExpired
 }) => {
   const [textBlocks, setTextBlocks] = useState<TextBlock[]>([]);
   const [mediaImages, setMediaImages] = useState<string[]>([]);
@@ -323,6 +326,23 @@ This environment allows you to:
     });
   }, [textBlocks]);
 
+  const postBlock = (idx: number, block: TextBlock) =>
+    axios.post('http://localhost:8000/api/body', {
+    // axios.post('http://localhost:8000/api/demo', { // Send to demo since body does not work yet
+      id: idx,
+      text: block.text,
+      balise: block.balise || 'default'
+    });
+
+  const handleBodyResponse = (response: AxiosResponse) => {
+    console.log('Reponse: ', response);
+    // If the API responds with data, handle it based on balise type.
+    // Coalesced responses repeat an answer already given to an earlier save.
+    if (response.data && response.headers['x-coalesced'] !== '1') {
+      handleAPIResponse(response.data);
+    }
+  };
+
   const handleKeyDown = (e: React.KeyboardEvent<HTMLTextAreaElement>, idx: number) => {
     if (e.key === 'Enter' && e.shiftKey) {
       e.preventDefault();
@@ -330,18 +350,15 @@ This environment allows you to:
       newBlocks[idx].mode = 'render';
       setTextBlocks(newBlocks);
       // API call on save
-      axios.post('http://localhost:8000/api/body', {
-      // axios.post('http://localhost:8000/api/demo', { // Send to demo since body does not work yet
-        id: idx,
-        text: newBlocks[idx].text,
-        balise: newBlocks[idx].balise || 'default'
-      }).then(response => {
-        console.log('Reponse: ', response);
-        // If the API responds with data, handle it based on balise type
-        if (response.data) {
-          handleAPIResponse(response.data);
+      postBlock(idx, newBlocks[idx]).then(handleBodyResponse).catch((err) => {
+        if (err.response?.status === 410 && onSessionExpired) {
+          // The backend session expired: start a new one and send the whole page again,
+          // the submissions are coalesced into a single answer
+          onSessionExpired()
+            .then(() => Promise.all(newBlocks.map((block, i) => postBlock(i, block).then(handleBodyResponse))))
+            .catch((retryErr) => console.error('Failed to save blocks in a new session:', retryErr));
+          return;
         }
-      }).catch((err) => {
         // Optionally handle error
         console.error('Failed to save block:', err);
       });